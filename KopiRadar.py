@@ -8,6 +8,8 @@ import json
 import traceback
 import googlemaps
 import sqlite3
+import signal
+import multiprocessing
 
 from ConfigParser import SafeConfigParser
 from datetime import datetime
@@ -17,8 +19,13 @@ from datetime import datetime
 # from telegram.ext import Job
 # from telegram.error import (TelegramError, Unauthorized, BadRequest, TimedOut,NetworkError)
 
+from lib.config import read_config, get_option
+from lib.constants import _DEFAULT_DB_POOL_SIZE, _DEFAULT_BUSY_TIMEOUT, _DEFAULT_CACHE_SIZE, _DEFAULT_SYNCHRONOUS
+from lib.constants import _DEFAULT_WRITE_BATCH, _DEFAULT_WRITE_INTERVAL, _DEFAULT_SHARD_WORKERS
 from lib.database import Database
 from lib.radar import Radar
+from lib.shard import Coordinator
+from lib import migrations
 
 log = logging.getLogger()
 
@@ -26,13 +33,76 @@ def init_logging():
     logging.basicConfig(format='[%(asctime)s] %(message)s', datefmt='%m/%d/%Y %I:%M:%S %p')
     log.setLevel(logging.DEBUG)
 
-def init_database():
-    d = Database()
+def init_database(upgrade=True):
+    parser = read_config()
+    d = Database(
+        pool_size=get_option(parser, 'database', 'pool_size', _DEFAULT_DB_POOL_SIZE),
+        busy_timeout=get_option(parser, 'database', 'busy_timeout', _DEFAULT_BUSY_TIMEOUT),
+        cache_size=get_option(parser, 'database', 'cache_size', _DEFAULT_CACHE_SIZE),
+        synchronous=get_option(parser, 'database', 'synchronous', _DEFAULT_SYNCHRONOUS),
+        write_batch=get_option(parser, 'database', 'write_batch', _DEFAULT_WRITE_BATCH),
+        write_interval=get_option(parser, 'database', 'write_interval', _DEFAULT_WRITE_INTERVAL),
+        upgrade=upgrade)
     return d
 
+def migrate():
+    """ Upgrade the schema to the latest version, returns the exit status"""
+    d = None
+    try:
+        d = init_database(upgrade=False)
+        log.info("Database schema is at version {0} (latest {1})".format(migrations.current_version(d.engine), migrations.LATEST))
+        version = migrations.upgrade(d.engine)
+        log.info("Database schema upgraded to version {0}".format(version))
+    except Exception:
+        log.exception("Migration failed")
+        return 1
+    finally:
+        if d != None:
+            d.close()
+    return 0
+
+def run_worker(index, queues):
+    # Ctrl-C reaches the whole process group; workers wait for the coordinator to stop them
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    # every process opens its own database, connections must not cross a fork
+    d = init_database()
+    peers = [q for i, q in enumerate(queues) if i != index]
+    try:
+        Radar(d, shard=(index, len(queues))).serve(queues[index], peers)
+    finally:
+        d.close()
+
+def shard(workers):
+    """ Run `workers` Radar processes, each owning the chats whose id falls in
+        its shard, behind one process that polls Telegram"""
+    parser = read_config()
+    queues = [multiprocessing.Queue() for i in range(workers)]
+    processes = [multiprocessing.Process(target=run_worker, args=(i, queues), name="radar-{0}".format(i)) for i in range(workers)]
+    for p in processes:
+        p.start()
+
+    commands = [(name, pass_args) for name, handler, pass_args in Radar.COMMANDS]
+    Coordinator(parser.get('general', 'telegram_key'), commands, queues).start()
+
+    for p in processes:
+        p.join()
+
 if __name__ == "__main__":
     init_logging()
-    d = init_database()
-    radar = Radar(d)
-    radar.start()
+    workers = get_option(read_config(), 'shard', 'workers', _DEFAULT_SHARD_WORKERS)
+
+    if len(sys.argv) > 1 and sys.argv[1] == "shard":
+        workers = int(sys.argv[2]) if len(sys.argv) > 2 else (workers or multiprocessing.cpu_count())
+
+    if len(sys.argv) > 1 and sys.argv[1] == "migrate":
+        sys.exit(migrate())
+    elif workers > 0:
+        # upgrade the schema once before the workers open the file
+        init_database().close()
+        shard(workers)
+    else:
+        d = init_database()
+        radar = Radar(d)
+        radar.start()
+        d.close()
     
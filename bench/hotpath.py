@@ -0,0 +1,271 @@
+""" Benchmarks of the Radar and Database hot paths, run against a throwaway
+    database with stub gmaps and Telegram objects, and written out as JSON so
+    runs can be compared across versions.
+
+    python -m bench.hotpath [--chats 100,1000] [--history 100,1000] [--specials 10,100]
+                            [--sightings 20] [--rounds 200] [--output results.json]
+"""
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import platform
+import argparse
+import tempfile
+import subprocess
+from contextlib import contextmanager
+
+import lib.radar as radar
+from lib.database import Database, History, SpecialLocation, chatid_history
+from lib.dedup import AlertIndex
+from lib.geocache import ReverseGeocodeCache, ForwardGeocodeCache
+from lib.sighting import parse_sightings
+from bench.startup import populate
+
+_CHATS      = [100, 1000]
+_HISTORY    = [100, 1000]
+_SPECIALS   = [10, 100]
+_SIGHTINGS  = 20
+_ROUNDS     = 200
+_CENTER     = (1.289041, 103.789332)
+
+class StubGmaps(object):
+    """ googlemaps.Client that answers at once without a network"""
+
+    def __init__(self, key=None):
+        self.calls = 0
+
+    def reverse_geocode(self, location):
+        self.calls += 1
+        return [{"formatted_address": "{0:.4f},{1:.4f} Singapore".format(location[0], location[1])}]
+
+    def geocode(self, address):
+        self.calls += 1
+        return [{"formatted_address": address, "geometry": {"location": {"lat": _CENTER[0], "lng": _CENTER[1]}}}]
+
+class StubBot(object):
+    def __init__(self):
+        self.sent = 0
+
+    def sendMessage(self, chat_id, text, **kwargs):
+        self.sent += 1
+
+class StubDispatcher(object):
+    def add_handler(self, handler):
+        pass
+
+class StubUpdater(object):
+    def __init__(self, token=None):
+        self.bot = StubBot()
+        self.dispatcher = StubDispatcher()
+
+class _StubGooglemaps(object):
+    Client = StubGmaps
+
+@contextmanager
+def stub_radar(tmp_dir):
+    """ Make Radar use the stub Telegram and gmaps clients, and keep its
+        geocode caches in tmp_dir so the real cache is left alone"""
+    path = os.path.join(tmp_dir, "geocode.db")
+    saved = radar.Updater, radar.googlemaps, radar.ReverseGeocodeCache, radar.ForwardGeocodeCache
+    radar.Updater, radar.googlemaps = StubUpdater, _StubGooglemaps
+    radar.ReverseGeocodeCache = lambda **kwargs: ReverseGeocodeCache(path=path, **kwargs)
+    radar.ForwardGeocodeCache = lambda **kwargs: ForwardGeocodeCache(path=path, **kwargs)
+    try:
+        yield
+    finally:
+        radar.Updater, radar.googlemaps, radar.ReverseGeocodeCache, radar.ForwardGeocodeCache = saved
+
+def build_radar(database, tmp_dir):
+    with stub_radar(tmp_dir):
+        return radar.Radar(database)
+
+def synthetic_payload(count, seed=0, center=_CENTER, spread=0.002, now=None):
+    """ A fastpokemap-shaped response with `count` sightings around center"""
+    rng = random.Random(seed)
+    now = now or time.time()
+    result = []
+    for i in range(count):
+        record = {
+            "encounter_id": str(rng.getrandbits(63)),
+            "spawn_point_id": "{0:x}".format(rng.getrandbits(40)),
+            "pokemon_id": "POKEMON{0}".format(rng.randint(1, 151)).upper(),
+            "latitude": center[0] + rng.uniform(-spread, spread),
+            "longitude": center[1] + rng.uniform(-spread, spread),
+        }
+        if rng.random() < 0.9:
+            record["expiration_timestamp_ms"] = str(int((now + rng.uniform(60, 900)) * 1000))
+        result.append(record)
+    return {"result": result}
+
+def populate_history(database, chats, per_chat):
+    """ `per_chat` live history rows for each of the first `chats` chats"""
+    now = int(time.time())
+    engine = database.engine
+    engine.execute(History.__table__.insert(), [
+        {"id": i, "name": "POKEMON{0}".format(i % 151), "lat": _CENTER[0] + i * 1e-6, "lng": _CENTER[1], "expire": now + 600, "seen": now}
+        for i in range(1, per_chat + 1)])
+    engine.execute(chatid_history.insert(), [
+        {"chat_id": c, "history_id": i} for c in range(1, chats + 1) for i in range(1, per_chat + 1)])
+
+def populate_specials(database, count, seed=0):
+    rng = random.Random(seed)
+    rows = []
+    for i in range(1, count + 1):
+        lat = _CENTER[0] + rng.uniform(-0.1, 0.1)
+        lng = _CENTER[1] + rng.uniform(-0.1, 0.1)
+        rows.append({"id": i, "name": "special{0}".format(i), "minlat": lat - 0.003, "maxlat": lat + 0.003, "minlng": lng - 0.003, "maxlng": lng + 0.003})
+    database.engine.execute(SpecialLocation.__table__.insert(), rows)
+    database.reload_special_index()
+    return rows
+
+def measure(name, params, func, rounds):
+    """ Call func() `rounds` times and summarise the wall time of each call"""
+    times = []
+    for i in range(rounds):
+        start = time.time()
+        func()
+        times.append(time.time() - start)
+    times.sort()
+    return {
+        "bench":    name,
+        "params":   params,
+        "rounds":   rounds,
+        "total_s":  sum(times),
+        "mean_us":  sum(times) / rounds * 1e6,
+        "median_us": times[rounds // 2] * 1e6,
+        "p95_us":   times[min(rounds - 1, int(rounds * 0.95))] * 1e6,
+        "min_us":   times[0] * 1e6,
+    }
+
+@contextmanager
+def scratch_database():
+    tmp_dir = tempfile.mkdtemp()
+    database = Database(os.path.join(tmp_dir, "bench.db"))
+    try:
+        yield database, tmp_dir
+    finally:
+        database.close()
+        shutil.rmtree(tmp_dir)
+
+def bench_init(chats, rounds):
+    with scratch_database() as (database, tmp_dir):
+        populate(database, chats)
+        populate_history(database, chats, 10)
+
+        def init():
+            r = build_radar(database, tmp_dir)
+            r.reverse_cache.close()
+            r.forward_cache.close()
+        return measure("radar_init", {"chats": chats}, init, max(1, rounds // 20))
+
+def bench_process_result(chats, sightings, rounds):
+    with scratch_database() as (database, tmp_dir):
+        populate(database, chats)
+        r = build_radar(database, tmp_dir)
+        delivered = list(parse_sightings(synthetic_payload(sightings)["result"]))
+        chatids = sorted(r.subscribers)
+
+        def tick():
+            # every chat gets the same sightings, as they would from one tile
+            r.alerts = AlertIndex()
+            r.renderer.reset()
+            for chatid in chatids:
+                r._process_result(chatid, delivered)
+        result = measure("process_result", {"chats": chats, "sightings": sightings}, tick, max(1, rounds // 20))
+        result["per_chat_us"] = result["mean_us"] / chats
+        r.reverse_cache.close()
+        r.forward_cache.close()
+        database.writes.flush()
+        return result
+
+def bench_check_history(history, rounds):
+    with scratch_database() as (database, tmp_dir):
+        populate(database, 1)
+        populate_history(database, 1, history)
+        rng = random.Random(0)
+        now = int(time.time())
+
+        def check():
+            i = rng.randint(1, history)
+            database.check_history(100001, "POKEMON{0}".format(i % 151), _CENTER[0] + i * 1e-6, _CENTER[1], now + 600)
+        return measure("check_history", {"history": history}, check, rounds)
+
+def bench_add_history(history, rounds):
+    with scratch_database() as (database, tmp_dir):
+        populate(database, 1)
+        counter = [0]
+
+        def add():
+            # one tick's worth of alerts, queued and then written through
+            for i in range(history):
+                counter[0] += 1
+                database.add_history(100001, "POKEMON{0}".format(counter[0] % 151), _CENTER[0] + counter[0] * 1e-6, _CENTER[1], 0)
+            database.writes.flush()
+        result = measure("add_history", {"history": history}, add, max(1, rounds // 20))
+        result["per_row_us"] = result["mean_us"] / history
+        return result
+
+def bench_speciallocation(specials, rounds):
+    with scratch_database() as (database, tmp_dir):
+        rows = populate_specials(database, specials)
+        rng = random.Random(0)
+
+        def check():
+            row = rows[rng.randrange(len(rows))]
+            database.check_speciallocation(row["minlat"], row["maxlat"], row["minlng"], row["maxlng"])
+
+        def find():
+            database.find_speciallocation(_CENTER[0] + rng.uniform(-0.1, 0.1), _CENTER[1] + rng.uniform(-0.1, 0.1))
+
+        return [measure("check_speciallocation", {"specials": specials}, check, rounds),
+                measure("find_speciallocation", {"specials": specials}, find, rounds)]
+
+def revision():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], stderr=open(os.devnull, "w")).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def run(chats=_CHATS, history=_HISTORY, specials=_SPECIALS, sightings=_SIGHTINGS, rounds=_ROUNDS):
+    results = []
+    for n in chats:
+        results.append(bench_init(n, rounds))
+        results.append(bench_process_result(n, sightings, rounds))
+    for n in history:
+        results.append(bench_check_history(n, rounds))
+        results.append(bench_add_history(n, rounds))
+    for n in specials:
+        results.extend(bench_speciallocation(n, rounds))
+    return {
+        "revision": revision(),
+        "python":   platform.python_version(),
+        "platform": platform.platform(),
+        "time":     int(time.time()),
+        "results":  results,
+    }
+
+def _sizes(value):
+    return [int(x) for x in value.split(",") if x]
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the Radar and Database hot paths")
+    parser.add_argument("--chats", type=_sizes, default=_CHATS)
+    parser.add_argument("--history", type=_sizes, default=_HISTORY)
+    parser.add_argument("--specials", type=_sizes, default=_SPECIALS)
+    parser.add_argument("--sightings", type=int, default=_SIGHTINGS)
+    parser.add_argument("--rounds", type=int, default=_ROUNDS)
+    parser.add_argument("--output", help="write the JSON here instead of stdout")
+    args = parser.parse_args()
+
+    report = run(args.chats, args.history, args.specials, args.sightings, args.rounds)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+        for row in report["results"]:
+            print "{0:<24} {1:<36} {2:>12.1f}us".format(row["bench"], json.dumps(row["params"], sort_keys=True), row["mean_us"])
+    else:
+        json.dump(report, sys.stdout, indent=2, sort_keys=True)
+        print
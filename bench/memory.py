@@ -0,0 +1,75 @@
+""" Memory held by Radar's per-chat state: the five parallel dicts it used to
+    keep against one dict of slotted Subscriber records.
+
+    python -m bench.memory [chats ...]
+"""
+import sys
+import random
+
+from lib.subscriber import Subscriber
+from lib.species import SPECIES
+
+_SIZES = [100000]
+
+def deep_size(obj, seen=None):
+    """ sys.getsizeof of obj and everything reachable from it, counting shared objects once"""
+    if seen is None:
+        seen = set()
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        size += sum(deep_size(k, seen) + deep_size(v, seen) for k, v in obj.iteritems())
+    elif isinstance(obj, (list, tuple, set, frozenset)):
+        size += sum(deep_size(x, seen) for x in obj)
+    elif hasattr(obj, "__slots__"):
+        size += sum(deep_size(getattr(obj, name), seen) for name in obj.__slots__ if hasattr(obj, name))
+    return size
+
+def synthetic_chats(chats, seed=0):
+    """ (chatid, lat, lng, filter_switch, filters, locations, favs), most chats with nothing set"""
+    rng = random.Random(seed)
+    names = list(SPECIES.names[:150])
+    for i in range(chats):
+        configured = rng.random() < 0.2
+        yield (
+            100000 + i, 1.2 + rng.random() * 0.25, 103.6 + rng.random() * 0.4, int(configured),
+            rng.sample(names, 5) if configured else [],
+            [("loc{0}".format(j), 1.3, 103.8) for j in range(2)] if configured else [],
+            rng.sample(names, 2) if configured else [],
+        )
+
+def old_layout(rows):
+    filters, locations, favs, chatids, filterswitch = {}, {}, {}, {}, {}
+    for x, lat, lng, switch, f, l, v in rows:
+        filters[x] = list(f)
+        locations[x] = [(name, float(a), float(b)) for name, a, b in l]
+        favs[x] = list(v)
+        chatids[x] = (lat, lng)
+        filterswitch[x] = switch
+    return (filters, locations, favs, chatids, filterswitch)
+
+def new_layout(rows):
+    return dict((x, Subscriber(x, lat, lng, switch, SPECIES.lookup(f)[0], l, SPECIES.lookup(v)[0])) for x, lat, lng, switch, f, l, v in rows)
+
+def run(sizes):
+    results = []
+    for chats in sizes:
+        rows = list(synthetic_chats(chats))
+        # the pokemon name strings are shared by both layouts, count them once up front
+        seen = set()
+        deep_size(rows, seen)
+        shared = set(seen)
+        old = deep_size(old_layout(rows), set(shared))
+        new = deep_size(new_layout(rows), set(shared))
+        results.append({"chats": chats, "old_bytes": old, "new_bytes": new})
+    return results
+
+if __name__ == "__main__":
+    sizes = [int(x) for x in sys.argv[1:]] or _SIZES
+    print "{0:>8} {1:>14} {2:>14} {3:>10}".format("chats", "old(bytes)", "new(bytes)", "per chat")
+    for row in run(sizes):
+        print "{0:>8} {1:>14} {2:>14} {3:>4}->{4:<4}".format(
+            row["chats"], row["old_bytes"], row["new_bytes"], row["old_bytes"] / row["chats"], row["new_bytes"] / row["chats"])
@@ -0,0 +1,79 @@
+""" Cost of building alert messages: the old per-chat string concatenation
+    against AlertRenderer, which formats each sighting once per tick and joins
+    the fragments for every chat. Address lookups are stubbed out.
+
+    python -m bench.render [chats ...]
+"""
+import sys
+import time
+import random
+
+from lib.render import AlertRenderer
+from lib.sighting import Sighting
+
+_SIZES      = [1, 10, 100]
+_SIGHTINGS  = 20
+_ROUNDS     = 50
+
+def synthetic_sightings(count, seed=0):
+    rng = random.Random(seed)
+    return [Sighting("Pokemon{0}".format(i), "pokemon{0}".format(i), 1.3 + rng.random() * 0.01, 103.8 + rng.random() * 0.01,
+                     1476000000 + i, "2016-10-09 16:00:00") for i in range(count)]
+
+def locate(location):
+    return "20 Science Park Dr Singapore 118230"
+
+def special(location):
+    return False
+
+def concatenate(sightings):
+    """ The per-chat rendering _process_result used to do"""
+    message = ""
+    summaries = ""
+    for sighting in sightings:
+        pokemon_location = (sighting.lat, sighting.lng)
+        location_by_name = locate(pokemon_location)
+        special_location = special(pokemon_location)
+        location_by_gmap = "https://www.google.com/maps/place/" + str(pokemon_location[0]) + "," + str(pokemon_location[1])
+
+        message += "{0}: {1}\n{2}\n{3}\n".format(sighting.pokemon, sighting.expire, location_by_name, location_by_gmap)
+        if special_location != False:
+            message += "{0}\n\n".format(special_location.upper())
+        else:
+            message += "({0},{1})\n\n".format(str(pokemon_location[0]), str(pokemon_location[1]))
+        summaries += sighting.pokemon.upper()
+        summaries += " "
+    return summaries + "\n\n" + message
+
+def run(sizes, sightings=_SIGHTINGS, rounds=_ROUNDS):
+    batch = synthetic_sightings(sightings)
+    renderer = AlertRenderer(locate, special)
+    assert renderer.message(batch) == concatenate(batch)
+
+    results = []
+    for chats in sizes:
+        start = time.time()
+        for i in range(rounds):
+            for chat in range(chats):
+                concatenate(batch)
+        old = (time.time() - start) / rounds
+
+        start = time.time()
+        for i in range(rounds):
+            renderer.reset()
+            for chat in range(chats):
+                renderer.message(batch)
+        new = (time.time() - start) / rounds
+
+        results.append({"chats": chats, "sightings": sightings, "old_tick": old, "new_tick": new,
+                        "old_per_sighting": old / (chats * sightings), "new_per_sighting": new / (chats * sightings)})
+    return results
+
+if __name__ == "__main__":
+    sizes = [int(x) for x in sys.argv[1:]] or _SIZES
+    print "{0:>8} {1:>10} {2:>12} {3:>12} {4:>16} {5:>16}".format(
+        "chats", "sightings", "old(ms)", "new(ms)", "old(us/sighting)", "new(us/sighting)")
+    for row in run(sizes):
+        print "{0:>8} {1:>10} {2:>12.3f} {3:>12.3f} {4:>16.2f} {5:>16.2f}".format(
+            row["chats"], row["sightings"], row["old_tick"] * 1e3, row["new_tick"] * 1e3,
+            row["old_per_sighting"] * 1e6, row["new_per_sighting"] * 1e6)
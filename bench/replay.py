@@ -0,0 +1,102 @@
+""" Drive the whole Radar pipeline from a recording of upstream responses:
+    stream parsing, matching, dedup, rendering and the outbox queue, with
+    stub gmaps and Telegram objects and chats placed on every recorded tile.
+
+    python -m bench.replay FILE [--speed 0] [--chats-per-tile 5] [--output results.json]
+    python -m bench.replay FILE --synthesize 50   # write a synthetic recording first
+
+    Record real traffic by setting [upstream] record in conf/KopiRadar.cfg.
+"""
+import sys
+import json
+import time
+import random
+import argparse
+
+from lib.replay import Recorder, replay, read_records, shift_expiry
+from lib.stream import find_results, iter_results
+from lib.metrics import STAGES
+from bench.hotpath import scratch_database, build_radar, synthetic_payload, _CENTER
+
+class _Silent(object):
+    def close(self):
+        pass
+
+def synthesize(path, tiles, scans=10, interval=60.0, sightings=20, seed=0):
+    """ Write a recording of `scans` rounds over `tiles` tiles near the default location"""
+    rng = random.Random(seed)
+    recorder = Recorder(_Silent(), path)
+    centers = [(_CENTER[0] + rng.uniform(-0.05, 0.05), _CENTER[1] + rng.uniform(-0.05, 0.05)) for i in range(tiles)]
+    start = time.time()
+    for scan in range(scans):
+        for i, center in enumerate(centers):
+            at = start + scan * interval + i * interval / tiles
+            payload = synthetic_payload(sightings, seed=seed * 1000 + scan * tiles + i, center=center, now=at)
+            recorder.record(center, json.dumps(payload), at)
+    recorder.close()
+
+def run(path, speed=0.0, chats_per_tile=5):
+    records = list(read_records(path))
+    with scratch_database() as (database, tmp_dir):
+        # chats on every recorded tile, as if users had set their location there
+        chatid = 100000
+        tiles = set()
+        for r in records:
+            tiles.add((r["lat"], r["lng"]))
+        for lat, lng in sorted(tiles):
+            for i in range(chats_per_tile):
+                chatid += 1
+                database.add_chatid(chatid, lat, lng)
+
+        r = build_radar(database, tmp_dir)
+        before = dict((stage, h.count) for stage, h in STAGES.items())
+
+        def sink(coordinates, body, recorded_at):
+            if body is None:
+                return
+            # keep the recorded expiries live, the dedup index evicts anything past
+            body = shift_expiry(body, recorded_at, time.time(), 1.0)
+            start = find_results(body)
+            if start is not None:
+                r.engine.results.put((r.scheduler.tile_of(*coordinates), coordinates, iter_results(body, start)))
+                r._drain_results(None, None)
+
+        started = time.time()
+        count = replay(path, sink, speed)
+        elapsed = time.time() - started
+        database.writes.flush()
+
+        report = {
+            "recording":        path,
+            "speed":            speed,
+            "records":          count,
+            "tiles":            len(tiles),
+            "chats":            len(r.subscribers),
+            "elapsed_s":        elapsed,
+            "records_per_s":    count / elapsed if elapsed else None,
+            "messages_queued":  len(r.outbox),
+            "stage_calls":      dict((stage, h.count - before[stage]) for stage, h in STAGES.items()),
+        }
+        r.reverse_cache.close()
+        r.forward_cache.close()
+        return report
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Replay recorded upstream responses through Radar")
+    parser.add_argument("recording")
+    parser.add_argument("--speed", type=float, default=0.0, help="1 for real time, 0 for as fast as possible")
+    parser.add_argument("--chats-per-tile", type=int, default=5)
+    parser.add_argument("--synthesize", type=int, metavar="TILES", help="write a synthetic recording over this many tiles first")
+    parser.add_argument("--output", help="write the JSON here instead of stdout")
+    args = parser.parse_args()
+
+    if args.synthesize:
+        synthesize(args.recording, args.synthesize)
+
+    report = run(args.recording, args.speed, args.chats_per_tile)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+    else:
+        json.dump(report, sys.stdout, indent=2, sort_keys=True)
+        print
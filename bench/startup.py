@@ -0,0 +1,77 @@
+""" Compare the per-chat state load Radar used to do at startup against
+    Database.get_all_chat_states.
+
+    python -m bench.startup [chats ...]
+"""
+import os
+import sys
+import time
+import shutil
+import tempfile
+
+from lib.database import Database, ChatID, Filter, Location, Fav
+from lib.database import chatid_filters, chatid_locations, chatid_favs
+from lib.species import SPECIES
+
+_SIZES = [100, 1000, 5000]
+
+def populate(database, chats, per_chat=3):
+    """ Insert `chats` chats with `per_chat` filters, locations and favs each"""
+    engine = database.engine
+    engine.execute(ChatID.__table__.insert(), [
+        {"id": i, "chatid": 100000 + i, "lat": 1.289041, "lng": 103.789332, "filter_switch": i % 2,
+         "filter_bits": SPECIES.encode(sum(1 << ((i + j) % (per_chat * 10)) for j in range(per_chat)))}
+        for i in range(1, chats + 1)])
+
+    for model, table, column in ((Filter, chatid_filters, "filter_id"), (Fav, chatid_favs, "fav_id")):
+        engine.execute(model.__table__.insert(), [{"id": j, "name": "pokemon{0}".format(j)} for j in range(1, per_chat * 10 + 1)])
+        engine.execute(table.insert(), [
+            {"chat_id": i, column: (i + j) % (per_chat * 10) + 1}
+            for i in range(1, chats + 1) for j in range(per_chat)])
+
+    engine.execute(Location.__table__.insert(), [
+        {"id": i * per_chat + j, "name": "loc{0}".format(j), "lat": 1.28 + j * 0.001 + i * 1e-6, "lng": 103.78 + j * 0.001}
+        for i in range(1, chats + 1) for j in range(per_chat)])
+    engine.execute(chatid_locations.insert(), [
+        {"chat_id": i, "location_id": i * per_chat + j}
+        for i in range(1, chats + 1) for j in range(per_chat)])
+
+def load_per_chat(database):
+    """ The pre-bulk startup path: six lookups per chat"""
+    state = {}
+    for x in database.get_all_chatid():
+        locations   = database.get_locations_by_chatid(x)
+        filters     = database.get_filters_by_chatid(x)
+        favs        = database.get_favs_by_chatid(x)
+        state[x] = (
+            database.get_currentlocation(x), database.get_filterswitch(x),
+            filters, [(y.name, y.lat, y.lng) for y in locations], [y.name for y in favs])
+    return state
+
+def load_bulk(database):
+    return database.get_all_chat_states()
+
+def run(sizes):
+    results = []
+    for chats in sizes:
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            database = Database(os.path.join(tmp_dir, "bench.db"))
+            populate(database, chats)
+
+            row = {"chats": chats}
+            for name, loader in (("per_chat", load_per_chat), ("bulk", load_bulk)):
+                start = time.time()
+                loaded = loader(database)
+                row[name] = time.time() - start
+                assert len(loaded) == chats
+            results.append(row)
+        finally:
+            shutil.rmtree(tmp_dir)
+    return results
+
+if __name__ == "__main__":
+    sizes = [int(x) for x in sys.argv[1:]] or _SIZES
+    print "{0:>8} {1:>12} {2:>12} {3:>8}".format("chats", "per_chat(s)", "bulk(s)", "speedup")
+    for row in run(sizes):
+        print "{0:>8} {1:>12.3f} {2:>12.3f} {3:>7.1f}x".format(row["chats"], row["per_chat"], row["bulk"], row["per_chat"] / row["bulk"])
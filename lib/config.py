@@ -0,0 +1,18 @@
+import os
+
+from ConfigParser import SafeConfigParser
+
+from lib.constants import _ROOT
+
+_CONFIG_FILE = os.path.join(_ROOT, "conf", "KopiRadar.cfg")
+
+def read_config(config=_CONFIG_FILE):
+    parser = SafeConfigParser()
+    parser.read(config)
+    return parser
+
+def get_option(parser, section, option, default):
+    """ section.option cast to the type of default, or default when it is not set"""
+    if parser.has_option(section, option):
+        return type(default)(parser.get(section, option))
+    return default
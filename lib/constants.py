@@ -2,6 +2,61 @@ import os
 
 _current_dir    = os.path.abspath(os.path.dirname(__file__))
 _ROOT           = os.path.normpath(os.path.join(_current_dir, ".."))
+_SPECIES_FILE   = os.path.join(_ROOT, "utils", "pokemons.txt")
 _DEFAULT_LAT    = 1.289041
 _DEFAULT_LNG    = 103.789332
 _DEFAULT_NAME   = "20 Science Park Dr Singapore 118230"
+_DEFAULT_TILE_SIZE      = 0.002
+_DEFAULT_SCAN_INTERVAL  = 240.0
+_DEFAULT_MIN_INTERVAL   = 120.0
+_DEFAULT_MAX_INTERVAL   = 900.0
+_DEFAULT_IDLE_CYCLES    = 3
+_DEFAULT_IDLE_BACKOFF   = 1.5
+_DEFAULT_SCAN_JITTER    = 0.1
+_DEFAULT_SCAN_TICK      = 5.0
+_DEFAULT_EXPIRY_SETTLE  = 15.0
+_DEFAULT_SPAWN_BUCKET   = 60
+_DEFAULT_SPAWN_PHASES   = 32
+_DEFAULT_FAV_INTERVAL   = 60.0
+_DEFAULT_FAV_WINDOW     = 900.0
+_UPSTREAM_URL           = "https://api.fastpokemap.se/"
+_DEFAULT_FETCH_TIMEOUT  = 10.0
+_DEFAULT_POOL_SIZE      = 8
+_DEFAULT_CONCURRENCY    = 4
+_DEFAULT_BACKOFF_BASE   = 5.0
+_DEFAULT_BACKOFF_MAX    = 120.0
+_DEFAULT_MAX_ATTEMPTS   = 8
+_DEFAULT_DRAIN_INTERVAL = 1.0
+_DEFAULT_LOG_PAYLOAD    = 512
+_DEFAULT_GEOCODE_PRECISION  = 4
+_DEFAULT_GEOCODE_CAPACITY   = 10000
+_DEFAULT_GEOCODE_TTL        = 604800.0
+_DEFAULT_UNKNOWN_EXPIRE_TTL = 3600.0
+_EXPIRE_FORMAT              = "%Y-%m-%d %H:%M:%S"
+_UNKNOWN_EXPIRE             = "Can't Find Expire Time"
+_DEFAULT_PRUNE_INTERVAL     = 3600.0
+_DEFAULT_PRUNE_BATCH        = 500
+_DEFAULT_PRUNE_PAUSE        = 1.0
+_DEFAULT_SPATIAL_CELL       = 0.01
+_DEFAULT_DB_POOL_SIZE       = 5
+_DEFAULT_BUSY_TIMEOUT       = 30.0
+_DEFAULT_CACHE_SIZE         = 16000
+_DEFAULT_SYNCHRONOUS        = "NORMAL"
+_DEFAULT_WRITE_BATCH        = 200
+_DEFAULT_WRITE_INTERVAL     = 1.0
+_MESSAGE_LIMIT              = 4096
+_DEFAULT_SEND_RATE          = 30.0
+_DEFAULT_SEND_BURST         = 30
+_DEFAULT_CHAT_RATE          = 1.0
+_DEFAULT_CHAT_BURST         = 3
+_DEFAULT_SEND_WORKERS       = 4
+_DEFAULT_SEND_ATTEMPTS      = 5
+_DEFAULT_SEND_RETRY_BASE    = 1.0
+_DEFAULT_SEND_RETRY_MAX     = 60.0
+_DEFAULT_SHARD_WORKERS      = 0
+_DEFAULT_RESULT_TTL         = 120.0
+_DEFAULT_FETCH_LEASE        = 30.0
+_DEFAULT_METRICS_HOST       = "127.0.0.1"
+_DEFAULT_METRICS_PORT       = 9108
+_DEFAULT_RECORD_FLUSH       = 20
+_DEFAULT_REPLAY_SPEED       = 1.0
@@ -1,21 +1,34 @@
 import os
 import json
 import logging
+import time
 import traceback
+from contextlib import contextmanager
 from datetime import datetime
-from lib.constants import _ROOT
+from lib.constants import _ROOT, _DEFAULT_UNKNOWN_EXPIRE_TTL, _DEFAULT_PRUNE_BATCH
+from lib.constants import _DEFAULT_DB_POOL_SIZE, _DEFAULT_BUSY_TIMEOUT, _DEFAULT_CACHE_SIZE, _DEFAULT_SYNCHRONOUS
+from lib.constants import _DEFAULT_WRITE_BATCH, _DEFAULT_WRITE_INTERVAL
+from lib.spatial import GridIndex
+from lib import migrations
+from lib.writebehind import WriteBehind
+from lib.metrics import REGISTRY, STAGES
+from lib.species import SPECIES
 
 
 log = logging.getLogger(__name__)
 
+_WRITES = REGISTRY.counter("kopiradar_db_writes_total", "Queued database changes written")
+
 try:
     from sqlalchemy import create_engine, Column, not_
     from sqlalchemy.dialects.mysql import INTEGER as Integer
     from sqlalchemy import String, Boolean, Float, DateTime, Enum
-    from sqlalchemy import ForeignKey, Text, Index, Table
+    from sqlalchemy import ForeignKey, Text, Index, Table, LargeBinary
     from sqlalchemy.ext.declarative import declarative_base
     from sqlalchemy.exc import SQLAlchemyError, IntegrityError
-    from sqlalchemy.orm import sessionmaker, relationship, joinedload
+    from sqlalchemy.orm import sessionmaker, relationship, joinedload, subqueryload
+    from sqlalchemy import or_, and_, event
+    from sqlalchemy.pool import QueuePool
     from sqlalchemy.ext.hybrid import hybrid_property
     Base = declarative_base()
 except ImportError as e:
@@ -24,25 +37,33 @@ except ImportError as e:
 chatid_filters = Table(
     "chatid_filters", Base.metadata,
     Column("chat_id", Integer, ForeignKey("chatids.id")),
-    Column("filter_id", Integer, ForeignKey("filters.id"))
+    Column("filter_id", Integer, ForeignKey("filters.id")),
+    Index("ux_chatid_filters", "chat_id", "filter_id", unique=True),
+    Index("ix_chatid_filters_filter_id", "filter_id")
 )
 
 chatid_locations = Table(
     "chatid_locations", Base.metadata,
     Column("chat_id", Integer, ForeignKey("chatids.id")),
-    Column("location_id", Integer, ForeignKey("locations.id"))
+    Column("location_id", Integer, ForeignKey("locations.id")),
+    Index("ux_chatid_locations", "chat_id", "location_id", unique=True),
+    Index("ix_chatid_locations_location_id", "location_id")
 )
 
 chatid_favs = Table(
     "chatid_favs", Base.metadata,
     Column("chat_id", Integer, ForeignKey("chatids.id")),
-    Column("fav_id", Integer, ForeignKey("favs.id"))
+    Column("fav_id", Integer, ForeignKey("favs.id")),
+    Index("ux_chatid_favs", "chat_id", "fav_id", unique=True),
+    Index("ix_chatid_favs_fav_id", "fav_id")
 )
 
 chatid_history = Table(
     "chatid_history", Base.metadata,
     Column("chat_id", Integer, ForeignKey("chatids.id")),
-    Column("history_id", Integer, ForeignKey("history.id"))
+    Column("history_id", Integer, ForeignKey("history.id")),
+    Index("ux_chatid_history", "chat_id", "history_id", unique=True),
+    Index("ix_chatid_history_history_id", "history_id")
 )
 
 class ChatID(Base):
@@ -54,6 +75,7 @@ class ChatID(Base):
     lat = Column(Float(), nullable=False)
     lng = Column(Float(), nullable=False)
     filter_switch = Column(Integer, nullable=False)
+    filter_bits = Column(LargeBinary)   # SPECIES.encode() of the filter list
 
     filters     = relationship("Filter", secondary=chatid_filters, single_parent=True, backref="chatids")
     locations   = relationship("Location", secondary=chatid_locations, single_parent=True, backref="chatids")
@@ -72,6 +94,7 @@ class ChatID(Base):
 
 class Filter(Base):
     __tablename__ = "filters"
+    __table_args__ = (Index("ux_filters_name", "name", unique=True),)
 
     id = Column(Integer(), primary_key=True)
     name = Column(String(255), nullable=False)
@@ -84,6 +107,7 @@ class Filter(Base):
 
 class Fav(Base):
     __tablename__ = "favs"
+    __table_args__ = (Index("ux_favs_name", "name", unique=True),)
 
     id = Column(Integer(), primary_key=True)
     name = Column(String(255), nullable=False)
@@ -96,6 +120,7 @@ class Fav(Base):
 
 class Location(Base):
     __tablename__ = "locations"
+    __table_args__ = (Index("ux_locations", "name", "lat", "lng", unique=True),)
 
     id = Column(Integer(), primary_key=True)
     name = Column(String(255), nullable=False)
@@ -111,22 +136,27 @@ class Location(Base):
         self.lng = float(lng)
 
 class History(Base):
+    """ A sighting that has been alerted. expire is the epoch the pokemon
+        disappears at, or 0 when upstream did not say"""
     __tablename__ = "history"
+    __table_args__ = (Index("ux_history", "name", "lat", "lng", "expire", unique=True),)
 
     id = Column(Integer(), primary_key=True)
     name        = Column(String(255), nullable=False)
     lat         = Column(Float(), nullable=False)
     lng         = Column(Float(), nullable=False)
-    expire      = Column(String(255), nullable=False)
+    expire      = Column(Integer(), nullable=False, index=True)
+    seen        = Column(Integer(), nullable=False, index=True)
 
     def __repr__(self):
         return "<History({0}, {1}, {2}, {3}, {4})".format(self.id, self.name, self.lat, self.lng, self.expire)
 
-    def __init__(self, name, lat, lng, expire):
+    def __init__(self, name, lat, lng, expire, seen=None):
         self.name = name
         self.lat = float(lat)
         self.lng = float(lng)
-        self.expire = expire
+        self.expire = int(expire)
+        self.seen = int(seen or time.time())
 
 class SpecialLocation(Base):
     __tablename__ = "speciallocations"
@@ -150,8 +180,10 @@ class SpecialLocation(Base):
 
 
 class Database(object):
-    def __init__(self):
-        db_file     = os.path.join(_ROOT, "db", "kopiradar.db")
+    def __init__(self, db_file=None, pool_size=_DEFAULT_DB_POOL_SIZE, busy_timeout=_DEFAULT_BUSY_TIMEOUT,
+                 cache_size=_DEFAULT_CACHE_SIZE, synchronous=_DEFAULT_SYNCHRONOUS,
+                 write_batch=_DEFAULT_WRITE_BATCH, write_interval=_DEFAULT_WRITE_INTERVAL, upgrade=True):
+        db_file     = db_file or os.path.join(_ROOT, "db", "kopiradar.db")
         if not os.path.exists(db_file):
             db_dir = os.path.dirname(db_file)
             if not os.path.exists(db_dir):
@@ -160,301 +192,368 @@ class Database(object):
                 except:
                     log.error("Error in making {0}".format(db_dir))
 
-        self._connect_database("sqlite:///%s" % db_file)
+        self._connect_database("sqlite:///%s" % db_file, pool_size, busy_timeout, cache_size, synchronous)
 
+        # a half-upgraded schema must not be served, so failures here propagate
         try:
+            fresh = not self.engine.has_table(ChatID.__tablename__)
             Base.metadata.create_all(self.engine)
+            if fresh:
+                migrations.stamp(self.engine)
+            elif upgrade:
+                migrations.upgrade(self.engine)
+        except Exception:
+            log.exception("Unable to create or upgrade the database at {0}".format(db_file))
+            self.engine.dispose()
+            raise
+
+        # objects stay readable after the session that loaded them is closed
+        self.Session = sessionmaker(bind=self.engine, expire_on_commit=False)
+
+        self.special_index = GridIndex()
+        self._load_special_index(self.special_index)
+
+        # add_history and add_location are written behind; Radar
+        # keeps its own copy of that state so nothing reads them back early
+        self.writes = WriteBehind(self._apply_writes, write_batch, write_interval)
+
+    @contextmanager
+    def session_scope(self):
+        """ Unit of work: commit when the block succeeds, roll back when it
+            raises, and always give the connection back to the pool"""
+        session = self.Session()
+        try:
+            yield session
+            session.commit()
         except:
-            log.error("UNable to create/connect to database")
-
-        self.Session = sessionmaker(bind=self.engine)
-
-    def _connect_database(self, connection_string):
-        self.engine = create_engine(connection_string, connect_args={"check_same_thread": False})
+            session.rollback()
+            raise
+        finally:
+            session.close()
 
-    def _get_or_create(self, session, model, **kwargs):
-        instance = session.query(model).filter_by(**kwargs).first()
-        return instance or model(**kwargs)
+    def _load_special_index(self, index):
+        try:
+            with self.session_scope() as session:
+                for row in session.query(SpecialLocation):
+                    index.insert(row.id, row.name, row.minlat, row.maxlat, row.minlng, row.maxlng)
+        except SQLAlchemyError as e:
+            log.error("Error in loading special locations: {0}".format(e))
+        log.info("Indexed {0} special locations".format(len(index)))
+
+    def reload_special_index(self):
+        """ Rebuild the special location index after another process changed the table"""
+        index = GridIndex()
+        self._load_special_index(index)
+        self.special_index = index
+
+    def _connect_database(self, connection_string, pool_size, busy_timeout, cache_size, synchronous):
+        # the job queue, dispatcher and scan threads share this engine. With WAL,
+        # readers on their own pooled connections do not wait for a writer
+        self.engine = create_engine(connection_string, poolclass=QueuePool, pool_size=int(pool_size),
+                                    max_overflow=int(pool_size), pool_timeout=float(busy_timeout),
+                                    connect_args={"check_same_thread": False, "timeout": float(busy_timeout)})
+
+        @event.listens_for(self.engine, "connect")
+        def _tune_connection(dbapi_connection, connection_record):
+            cursor = dbapi_connection.cursor()
+            cursor.execute("PRAGMA journal_mode=WAL")
+            cursor.execute("PRAGMA synchronous={0}".format(synchronous))
+            cursor.execute("PRAGMA cache_size=-{0}".format(int(cache_size)))
+            cursor.execute("PRAGMA busy_timeout={0}".format(int(float(busy_timeout) * 1000)))
+            cursor.execute("PRAGMA temp_store=MEMORY")
+            cursor.close()
+
+    def flush(self):
+        return self.writes.flush()
+
+    def close(self):
+        self.writes.close()
+        self.engine.dispose()
+
+    def _apply_writes(self, batch):
+        _WRITES.inc(len(batch))
+        try:
+            with STAGES["db_write"].time(), self.session_scope() as session:
+                self._write_batch(session, batch)
+            log.debug("Wrote {0} queued changes".format(len(batch)))
+        except SQLAlchemyError as e:
+            log.error("Error in writing {0} queued changes, retrying one by one: {1}".format(len(batch), e))
+            for operation in batch:
+                try:
+                    with self.session_scope() as session:
+                        self._write_batch(session, [operation])
+                except SQLAlchemyError as e:
+                    log.error("Dropping {0}: {1}".format(operation, e))
+
+    def _write_batch(self, session, batch):
+        # rows and links are written with INSERT OR IGNORE against their unique
+        # keys, so repeats are no-ops and chats can share a row within a batch
+        chats = {}
+        entities = {}
+        now = int(time.time())
+        for operation in batch:
+            kind, chatid = operation[0], int(operation[1])
+            if chatid not in chats:
+                chats[chatid] = session.query(ChatID.id).filter_by(chatid=chatid).scalar()
+            if chats[chatid] == None:
+                log.warning("Chat ID {0} not in database, dropping {1}".format(chatid, operation))
+                continue
+
+            if kind == "history":
+                model, table, column, fields = History, chatid_history, "history_id", ("name", "lat", "lng", "expire")
+                defaults = {"seen": now}
+            else:
+                model, table, column, fields = Location, chatid_locations, "location_id", ("name", "lat", "lng")
+                defaults = {}
+
+            key = (kind,) + operation[2:]
+            if key not in entities:
+                entities[key] = self._upsert(session, model, defaults, **dict(zip(fields, operation[2:])))
+            if entities[key] == None:
+                log.warning("Could not write {0}, dropping it".format(operation))
+                continue
+            self._link(session, table, **{"chat_id": chats[chatid], column: entities[key]})
+
+    def _upsert(self, session, model, defaults={}, **kwargs):
+        """ id of the row equal to kwargs, inserted with defaults first if there is none"""
+        values = dict(defaults)
+        values.update(kwargs)
+        session.execute(model.__table__.insert().prefix_with("OR IGNORE").values(**values))
+        return session.query(model.id).filter_by(**kwargs).scalar()
+
+    def _link(self, session, table, **kwargs):
+        session.execute(table.insert().prefix_with("OR IGNORE").values(**kwargs))
 
     def get_all_chatid(self):
-        session = self.Session()
-        chatids = session.query(ChatID)
-        result = []
-        for row in chatids:
-            result.append(row.chatid)
-        return result
+        with self.session_scope() as session:
+            return [row.chatid for row in session.query(ChatID.chatid)]
+
+    def get_all_chat_states(self):
+        """ (chatid, lat, lng, filter_switch, filters, locations, favs) for every chat,
+            loaded in a fixed number of queries however many chats there are.
+            filters is the chat's species bitset. Errors are left to the caller,
+            an empty list would look like a bot without chats"""
+        with self.session_scope() as session:
+            rows = session.query(ChatID).options(
+                subqueryload(ChatID.locations), subqueryload(ChatID.favs))
+            return [(
+                int(row.chatid), float(row.lat), float(row.lng), int(row.filter_switch),
+                SPECIES.decode(row.filter_bits),
+                [(l.name, l.lat, l.lng) for l in row.locations],
+                [f.name for f in row.favs],
+            ) for row in rows]
 
     def get_all_speciallocation(self):
-        session = self.Session()
-        x = session.query(SpecialLocation)
-        result = []
-        for row in x:
-            result.append(row.name)
-        return result
+        with self.session_scope() as session:
+            return [row.name for row in session.query(SpecialLocation.name)]
 
     def get_currentlocation(self, chatid):
-        session = self.Session()
-        tchatid  = session.query(ChatID).filter_by(chatid=int(chatid)).first()
-        return (float(tchatid.lat), float(tchatid.lng))
+        with self.session_scope() as session:
+            tchatid  = session.query(ChatID).filter_by(chatid=int(chatid)).first()
+            return (float(tchatid.lat), float(tchatid.lng))
 
     ##### Get all  BY Chat ID ######
+    # relationships are loaded before the session closes so callers can read them
     def get_filterswitch(self, chatid):
-        session = self.Session()
-        tchatid  = session.query(ChatID).filter_by(chatid=int(chatid)).first()
-        return int(tchatid.filter_switch)
+        with self.session_scope() as session:
+            tchatid  = session.query(ChatID).filter_by(chatid=int(chatid)).first()
+            return int(tchatid.filter_switch)
 
     def get_filters_by_chatid(self, chatid):
-        session = self.Session()
-        chatid = session.query(ChatID).filter_by(chatid=int(chatid)).first()
-        tfilter = chatid.filters
-        return tfilter
+        with self.session_scope() as session:
+            bits = session.query(ChatID.filter_bits).filter_by(chatid=int(chatid)).scalar()
+            return SPECIES.names_of(SPECIES.decode(bits))
 
     def get_favs_by_chatid(self, chatid):
-        session = self.Session()
-        chatid = session.query(ChatID).filter_by(chatid=int(chatid)).first()
-        tfavs = chatid.favs
-        return tfavs
+        with self.session_scope() as session:
+            chatid = session.query(ChatID).filter_by(chatid=int(chatid)).first()
+            return list(chatid.favs)
 
     def get_locations_by_chatid(self, chatid):
-        session = self.Session()
-        chatid = session.query(ChatID).filter_by(chatid=int(chatid)).first()
-        tlocations = chatid.locations
-        return tlocations
+        with self.session_scope() as session:
+            chatid = session.query(ChatID).filter_by(chatid=int(chatid)).first()
+            return list(chatid.locations)
 
     def get_history_by_chatid(self, chatid):
-        session = self.Session()
-        chatid = session.query(ChatID).filter_by(chatid=int(chatid)).first()
-        thistory = chatid.history
-        return thistory
+        with self.session_scope() as session:
+            chatid = session.query(ChatID).filter_by(chatid=int(chatid)).first()
+            return list(chatid.history)
+
+    def get_all_history(self, unknown_ttl=_DEFAULT_UNKNOWN_EXPIRE_TTL):
+        """ (chatid, name, lat, lng, expire, seen) for every alert that is still live.
+            Errors are left to the caller, an empty list would repeat every live alert"""
+        now = int(time.time())
+        with self.session_scope() as session:
+            rows = session.query(ChatID.chatid, History.name, History.lat, History.lng, History.expire, History.seen).join(ChatID.history)
+            rows = rows.filter(or_(History.expire > now, and_(History.expire == 0, History.seen > now - unknown_ttl)))
+            return [tuple(row) for row in rows]
 
     #### Update by CHAT ID#####
     def update_current_location(self, chatid, lat, lng):
-        session = self.Session()
-        chatid = session.query(ChatID).filter_by(chatid=int(chatid)).first()
         success = False
         try:
-            chatid.lat = float(lat)
-            chatid.lng = float(lng)
-            session.commit()
+            with self.session_scope() as session:
+                chatid = session.query(ChatID).filter_by(chatid=int(chatid)).first()
+                chatid.lat = float(lat)
+                chatid.lng = float(lng)
             success = True
         except:
             log.error("Some error happens")
-            session.rollback()
-        finally:
-            session.close()
-            return success
+        return success
 
     def update_filter_switch(self, chatid, switch):
-        session = self.Session()
-        chatid = session.query(ChatID).filter_by(chatid=int(chatid)).first()
         success = False
         try:
-            chatid.filter_switch = switch
-            session.commit()
+            with self.session_scope() as session:
+                chatid = session.query(ChatID).filter_by(chatid=int(chatid)).first()
+                chatid.filter_switch = switch
             success = True
         except:
             log.error("Some error happens")
-            session.rollback()
-        finally:
-            session.close()
-            return success
+        return success
+
+    def update_filters(self, chatid, bits):
+        """ Store the chat's whole filter list, a species bitset, in one column"""
+        success = False
+        try:
+            with self.session_scope() as session:
+                session.query(ChatID).filter_by(chatid=int(chatid)).update({"filter_bits": SPECIES.encode(bits)})
+            success = True
+        except SQLAlchemyError as e:
+            log.error("Error in updating filters of {0}: {1}".format(chatid, e))
+        return success
 
     #### Removal ####
     def remove_chatid(self, chatid):
-        session = self.Session()
+        self.flush()
         log.info("chatid: {0} [{1}]".format(int(chatid), type(chatid)))
-        c = session.query(ChatID).filter_by(chatid=int(chatid)).first()
         try:
-            log.info("deleting {0}".format(c))
-            session.delete(c)
-            session.commit()
+            with self.session_scope() as session:
+                c = session.query(ChatID).filter_by(chatid=int(chatid)).first()
+                log.info("deleting {0}".format(c))
+                session.delete(c)
         except:
             log.error("Delete error")
-            session.rollback()
             print traceback.format_exc()
-        finally:
-            session.close()
-
-    def remove_filter(self, chatid, name):
-        session = self.Session()
-        c = session.query(ChatID).filter_by(chatid=int(chatid)).first()
-
-        for f in c.filters:
-            if f.name == name:
-                try:
-                    session.delete(f)
-                    session.commit()
-                except:
-                    log.error("Delete error")
-                    session.rollback()
 
     def remove_location(self, chatid, name):
-        session = self.Session()
-        c = session.query(ChatID).filter_by(chatid=chatid).first()
-
-        for f in c.locations:
-            if f.name == name:
-                try:
-                    session.delete(f)
-                    session.commit()
-                except:
-                    log.error("Delete error")
-                    session.rollback()
+        self.flush()
+        try:
+            with self.session_scope() as session:
+                c = session.query(ChatID.id).filter_by(chatid=int(chatid)).scalar()
+                ids = [row[0] for row in session.query(Location.id).filter_by(name=name)]
+                # only this chat's link goes, the row may be shared with other chats
+                session.execute(chatid_locations.delete().where(and_(chatid_locations.c.chat_id == c, chatid_locations.c.location_id.in_(ids))))
+        except:
+            log.error("Delete error")
 
     def remove_speciallocation(self, name):
-        session = self.Session()
-        c = session.query(SpecialLocation).filter_by(name=name).first()
-
         try:
-            session.delete(c)
-            session.commit()
+            with self.session_scope() as session:
+                c = session.query(SpecialLocation).filter_by(name=name).first()
+                session.delete(c)
+            self.special_index.remove(c.id)
         except:
             log.error("Delete error")
-            session.rollback()
 
     def remove_fav(self, chatid, name):
-        session = self.Session()
-        c = session.query(ChatID).filter_by(chatid=chatid).first()
-
-        for f in c.favs:
-            if f.name == name:
-                try:
-                    session.delete(f)
-                    session.commit()
-                except:
-                    log.error("Delete error")
-                    session.rollback()
+        try:
+            with self.session_scope() as session:
+                c = session.query(ChatID.id).filter_by(chatid=int(chatid)).scalar()
+                ids = [row[0] for row in session.query(Fav.id).filter_by(name=name)]
+                # only this chat's link goes, the row may be shared with other chats
+                session.execute(chatid_favs.delete().where(and_(chatid_favs.c.chat_id == c, chatid_favs.c.fav_id.in_(ids))))
+        except:
+            log.error("Delete error")
 
     def check_history(self, chatid, name, lat, lng, expiretime):
-        session = self.Session()
-        c = session.query(ChatID).filter_by(chatid=int(chatid)).first()
         success = False
-        if c == None:
-            return False
         try:
-            for f in c.history:
-                if f.name == name and float(f.lat) == float(lat) and float(f.lng) == float(lng) and f.expire == expiretime:
-                    success = True
-                    break
-
+            with self.session_scope() as session:
+                c = session.query(ChatID).filter_by(chatid=int(chatid)).first()
+                if c == None:
+                    return False
+                for f in c.history:
+                    if f.name == name and float(f.lat) == float(lat) and float(f.lng) == float(lng) and f.expire == expiretime:
+                        success = True
+                        break
         except SQLAlchemyError as e:
             log.error("Error in adding chatid: {0}".format(e))
-            session.rollback()
-
-        finally:
-            session.close()
 
         return success
 
     def check_speciallocation(self, minlat, maxlat, minlng, maxlng):
-        session = self.Session()
-        sps = session.query(SpecialLocation)
+        with self.session_scope() as session:
+            for row in session.query(SpecialLocation):
+                if row.minlat == float(minlat) and row.maxlat == float(maxlat) and row.minlng == float(minlng) and row.maxlng == float(maxlng):
+                    return row.name
 
-        for row in sps:
-            if row.minlat == float(minlat) and row.maxlat == float(maxlat) and row.minlng == float(minlng) and row.maxlng == float(maxlng):
-                return row.name
+        return False
 
+    def find_speciallocation(self, lat, lng):
+        """ Name of the first special location whose box contains (lat, lng), or False"""
+        names = self.special_index.query(lat, lng)
+        if names:
+            return names[0]
         return False
 
     def add_chatid(self, chatid, lat, lng, filters=[], locations={}, favs=[]):
-        session = self.Session()
-        chatid = ChatID(chatid=chatid, lat=lat, lng=lng)
-        session.add(chatid)
-
         success = False
-
         try:
-            session.commit()
+            with self.session_scope() as session:
+                session.add(ChatID(chatid=chatid, lat=lat, lng=lng))
             success = True
         except SQLAlchemyError as e:
             log.error("Error in adding chatid: {0}".format(e))
-            session.rollback()
-        finally:
-            session.close()
-            return success
+        return success
 
-    def add_history(self, chatid, name, lat, lng, expiretime):
-        session = self.Session()
-        success = False
-        try:
-            c = session.query(ChatID).filter_by(chatid=chatid).first()
-            h = self._get_or_create(session, History, name=name, lat=lat, lng=lng, expire=expiretime)
+    def prune_history(self, batch_size=_DEFAULT_PRUNE_BATCH, unknown_ttl=_DEFAULT_UNKNOWN_EXPIRE_TTL):
+        """ Delete up to batch_size expired sightings and their chatid links in one
+            transaction. Returns how many were deleted, batch_size means more may be left"""
+        now = int(time.time())
+        expired = or_(and_(History.expire > 0, History.expire <= now), and_(History.expire == 0, History.seen <= now - unknown_ttl))
 
-            print c
-            print h
-            c.history.append(h)
-            log.info("Adding {0}, {1}, {2}, {3}".format(name, lat, lng, expiretime))
-            session.commit()
-            success = True
+        try:
+            with self.session_scope() as session:
+                ids = [row[0] for row in session.query(History.id).filter(expired).limit(batch_size)]
+                if ids:
+                    session.execute(chatid_history.delete().where(chatid_history.c.history_id.in_(ids)))
+                    session.query(History).filter(History.id.in_(ids)).delete(synchronize_session=False)
         except SQLAlchemyError as e:
-            log.debug("Error querying sample".format(e))
-            session.rollback()
-        except:
-            print traceback.format_exc()
-        finally:
-            session.close()
-            return success
+            log.error("Error in pruning history: {0}".format(e))
+            return 0
+
+        log.info("Pruned {0} expired sightings".format(len(ids)))
+        return len(ids)
+
+    def add_history(self, chatid, name, lat, lng, expiretime):
+        log.info("Adding {0}, {1}, {2}, {3}".format(name, lat, lng, expiretime))
+        self.writes.put(("history", int(chatid), name, float(lat), float(lng), int(expiretime)))
+        return True
 
     def add_location(self, chatid, name, lat, lng):
-        session = self.Session()
-        success = False
-        try:
-            chatid = session.query(ChatID).filter_by(chatid=chatid).first()
-            location = self._get_or_create(session, Location, name=name, lat=lat, lng=lng)
-            chatid.locations.append(location)
-            session.commit()
-            success = True
-        except SQLAlchemyError as e:
-            log.debug("Error querying sample".format(e))
-            session.rollback()
-        finally:
-            session.close()
-            return success
+        self.writes.put(("location", int(chatid), name, float(lat), float(lng)))
+        return True
 
     def add_speciallocation(self, name, minlat, maxlat, minlng, maxlng):
-        session = self.Session()
-        success = False
-        try:
-            session = self.Session()
-            sp = SpecialLocation(name=name, minlat=minlat, maxlat=maxlat, minlng=minlng,maxlng=maxlng)
-            session.add(sp)
-            session.commit()
-            success = True
-        except SQLAlchemyError as e:
-            log.debug("Error querying sample".format(e))
-            session.rollback()
-        finally:
-            session.close()
-            return success
-
-    def add_filter(self, chatid, name):
-        session = self.Session()
         success = False
         try:
-            chatid = session.query(ChatID).filter_by(chatid=str(chatid)).first()
-            f = self._get_or_create(session, Filter, name=name)
-            chatid.filters.append(f)
-            session.commit()
+            with self.session_scope() as session:
+                sp = SpecialLocation(name=name, minlat=minlat, maxlat=maxlat, minlng=minlng,maxlng=maxlng)
+                session.add(sp)
+            self.special_index.insert(sp.id, sp.name, sp.minlat, sp.maxlat, sp.minlng, sp.maxlng)
             success = True
         except SQLAlchemyError as e:
-            log.debug("Error querying sample".format(e))
-            session.rollback()
-        finally:
-            session.close()
-            return success
+            log.error("Error in adding special location {0}: {1}".format(name, e))
+        return success
 
     def add_fav(self, chatid, name):
-        session = self.Session()
         success = False
         try:
-            chatid = session.query(ChatID).filter_by(chatid=str(chatid)).first()
-            f = self._get_or_create(session, Fav, name=name)
-            chatid.favs.append(f)
-            session.commit()
+            with self.session_scope() as session:
+                c = session.query(ChatID.id).filter_by(chatid=int(chatid)).scalar()
+                self._link(session, chatid_favs, chat_id=c, fav_id=self._upsert(session, Fav, name=name))
             success = True
         except SQLAlchemyError as e:
-            log.debug("Error querying sample".format(e))
-            session.rollback()
-        finally:
-            session.close()
-            return success
+            log.error("Error in adding favourite {0} for {1}: {2}".format(name, chatid, e))
+        return success
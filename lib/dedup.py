@@ -0,0 +1,59 @@
+import time
+import heapq
+import logging
+import threading
+
+from lib.constants import _DEFAULT_UNKNOWN_EXPIRE_TTL
+
+log = logging.getLogger(__name__)
+
+class AlertIndex(object):
+    """ Set of (chatid, pokemon, lat, lng, expire) alerts that have already been
+        sent. Entries drop out once their sighting has expired, so the index
+        only ever holds what is still on the map"""
+
+    def __init__(self, unknown_ttl=_DEFAULT_UNKNOWN_EXPIRE_TTL):
+        self.unknown_ttl    = float(unknown_ttl)
+        self._alerts        = set()
+        self._expiry        = []    # heap of (expires_at, key)
+        self._lock          = threading.Lock()
+
+    def __len__(self):
+        return len(self._alerts)
+
+    def key(self, chatid, name, lat, lng, expire):
+        return (int(chatid), name, float(lat), float(lng), int(expire))
+
+    def contains(self, key, now=None):
+        with self._lock:
+            self._evict(now or time.time())
+            return key in self._alerts
+
+    def add(self, key, expires_at=None, now=None):
+        now = now or time.time()
+        if expires_at is None:
+            expires_at = now + self.unknown_ttl
+
+        with self._lock:
+            self._evict(now)
+            if expires_at <= now or key in self._alerts:
+                return False
+            self._alerts.add(key)
+            heapq.heappush(self._expiry, (expires_at, key))
+            return True
+
+    def load(self, rows, now=None):
+        """ rows are (chatid, name, lat, lng, expire, seen) tuples, expire is 0 when unknown"""
+        now = now or time.time()
+        loaded = 0
+        for chatid, name, lat, lng, expire, seen in rows:
+            expires_at = expire or seen + self.unknown_ttl
+            if self.add(self.key(chatid, name, lat, lng, expire), expires_at, now):
+                loaded += 1
+        log.info("Loaded {0} live alerts into the dedup index".format(loaded))
+        return loaded
+
+    def _evict(self, now):
+        while self._expiry and self._expiry[0][0] <= now:
+            expires_at, key = heapq.heappop(self._expiry)
+            self._alerts.discard(key)
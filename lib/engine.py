@@ -0,0 +1,158 @@
+import time
+import heapq
+import random
+import logging
+import threading
+import Queue
+
+from lib.constants import _DEFAULT_CONCURRENCY, _DEFAULT_BACKOFF_BASE, _DEFAULT_BACKOFF_MAX, _DEFAULT_MAX_ATTEMPTS
+from lib.constants import _DEFAULT_LOG_PAYLOAD
+from lib.stream import find_results, iter_results, preview
+from lib.metrics import REGISTRY, STAGES
+
+_SCANS      = REGISTRY.counter("kopiradar_upstream_scans_total", "Upstream scans that returned results")
+_OVERLOADED = REGISTRY.counter("kopiradar_upstream_overloaded_total", "Upstream responses that were missing, invalid or overloaded")
+_RETRIES    = REGISTRY.counter("kopiradar_upstream_retries_total", "Upstream scans rescheduled with backoff")
+_GAVE_UP    = REGISTRY.counter("kopiradar_upstream_gave_up_total", "Upstream scans dropped after max_attempts")
+
+log = logging.getLogger(__name__)
+
+class ScanEngine(object):
+    """ Run upstream scans on a bounded pool of worker threads.
+
+        An overloaded response is rescheduled with exponential backoff and
+        jitter instead of sleeping on the worker, so other scans keep going.
+        Finished scans are put on `results` as (key, coordinates, records) for
+        the Telegram side to pick up, where records is a generator that parses
+        the upstream result records one at a time"""
+
+    def __init__(self, fetcher, concurrency=_DEFAULT_CONCURRENCY, backoff_base=_DEFAULT_BACKOFF_BASE,
+                 backoff_max=_DEFAULT_BACKOFF_MAX, max_attempts=_DEFAULT_MAX_ATTEMPTS, log_payload=_DEFAULT_LOG_PAYLOAD):
+        self.fetcher        = fetcher
+        self.concurrency    = int(concurrency)
+        self.backoff_base   = float(backoff_base)
+        self.backoff_max    = float(backoff_max)
+        self.max_attempts   = int(max_attempts)
+        self.log_payload    = int(log_payload)
+        self.results        = Queue.Queue()
+
+        self._work      = Queue.Queue()
+        self._retries   = []    # heap of (due, seq, scan)
+        self._seq       = 0
+        self._cond      = threading.Condition()
+        self._pending   = set()
+        self._lock      = threading.Lock()
+        self._threads   = []
+        self._running   = False
+
+    def start(self):
+        self._running = True
+        for i in range(self.concurrency):
+            self._spawn(self._worker, "scan-worker-{0}".format(i))
+        self._spawn(self._retry_loop, "scan-retry")
+        log.info("Scan engine started with {0} workers".format(self.concurrency))
+
+    def stop(self):
+        with self._cond:
+            self._running = False
+            self._cond.notify_all()
+        for i in range(self.concurrency):
+            self._work.put(None)
+        for t in self._threads:
+            t.join()
+        self._threads = []
+
+    def submit(self, key, coordinates):
+        # a key that is still in flight (or backing off) is not scanned twice
+        with self._lock:
+            if key in self._pending:
+                return False
+            self._pending.add(key)
+        self._work.put((key, coordinates, 0))
+        return True
+
+    def pending(self):
+        with self._lock:
+            return len(self._pending)
+
+    def backing_off(self):
+        with self._cond:
+            return len(self._retries)
+
+    def _spawn(self, target, name):
+        t = threading.Thread(target=target, name=name)
+        t.daemon = True
+        t.start()
+        self._threads.append(t)
+
+    def _finish(self, key):
+        with self._lock:
+            self._pending.discard(key)
+
+    def _worker(self):
+        while True:
+            scan = self._work.get()
+            if scan is None:
+                break
+            try:
+                self._scan(*scan)
+            except Exception:
+                log.exception("Unexpected error scanning {0}".format(scan[0]))
+                self._finish(scan[0])
+
+    def _scan(self, key, coordinates, attempt):
+        start = None
+        with STAGES["fetch"].time():
+            response = self.fetcher.fetch(coordinates)
+
+        if response:
+            if log.isEnabledFor(logging.DEBUG):
+                log.debug("Response for {0}: {1}".format(key, preview(response, self.log_payload)))
+            try:
+                start = find_results(response)
+            except ValueError as e:
+                log.warning("Invalid response for {0}: {1}".format(key, e))
+
+        if start is not None:
+            _SCANS.inc()
+            self._finish(key)
+            self.results.put((key, coordinates, iter_results(response, start)))
+            return
+
+        _OVERLOADED.inc()
+        if attempt + 1 >= self.max_attempts:
+            _GAVE_UP.inc()
+            log.error("Giving up on {0} after {1} attempts".format(key, attempt + 1))
+            self._finish(key)
+            return
+
+        delay = self._backoff(attempt)
+        _RETRIES.inc()
+        log.info("Server is currently overloaded. Retrying {0} in {1:.1f}s: {2}".format(
+            key, delay, preview(response or "", self.log_payload)))
+        self._schedule(time.time() + delay, (key, coordinates, attempt + 1))
+
+    def _backoff(self, attempt):
+        cap = min(self.backoff_max, self.backoff_base * (2 ** attempt))
+        return random.uniform(cap / 2.0, cap)
+
+    def _schedule(self, due, scan):
+        with self._cond:
+            self._seq += 1
+            heapq.heappush(self._retries, (due, self._seq, scan))
+            self._cond.notify()
+
+    def _retry_loop(self):
+        with self._cond:
+            while self._running:
+                if not self._retries:
+                    self._cond.wait()
+                    continue
+
+                delay = self._retries[0][0] - time.time()
+                if delay > 0:
+                    self._cond.wait(delay)
+                    continue
+
+                due, seq, scan = heapq.heappop(self._retries)
+                self._work.put(scan)
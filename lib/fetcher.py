@@ -0,0 +1,105 @@
+import zlib
+import socket
+import logging
+import httplib
+import urlparse
+import Queue
+
+from lib.constants import _UPSTREAM_URL, _DEFAULT_FETCH_TIMEOUT, _DEFAULT_POOL_SIZE
+
+log = logging.getLogger(__name__)
+
+_HEADERS = {
+    "origin":           "https://fastpokemap.se",
+    "user-agent":       "Mozilla/5.0 (Windows NT 6.1) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/41.0.2228.0 Safari/537.36",
+    "authority":        "api.fastpokemap.se",
+    "accept-encoding":  "gzip, deflate",
+    "connection":       "keep-alive",
+}
+
+class Fetcher(object):
+    """ Keep-alive HTTP(S) client for the upstream scan API. Connections are
+        pooled and shared between the job queue and dispatcher threads"""
+
+    def __init__(self, base_url=_UPSTREAM_URL, timeout=_DEFAULT_FETCH_TIMEOUT, pool_size=_DEFAULT_POOL_SIZE):
+        parsed = urlparse.urlparse(base_url)
+
+        self.scheme     = parsed.scheme
+        self.host       = parsed.hostname
+        self.port       = parsed.port
+        self.path       = parsed.path or "/"
+        self.timeout    = float(timeout)
+        self.headers    = dict(_HEADERS)
+        self._pool      = Queue.LifoQueue(maxsize=int(pool_size))
+
+    def _new_connection(self):
+        if self.scheme == "https":
+            return httplib.HTTPSConnection(self.host, self.port, timeout=self.timeout)
+        return httplib.HTTPConnection(self.host, self.port, timeout=self.timeout)
+
+    def _acquire(self):
+        try:
+            return self._pool.get_nowait(), True
+        except Queue.Empty:
+            return self._new_connection(), False
+
+    def _release(self, conn):
+        try:
+            self._pool.put_nowait(conn)
+        except Queue.Full:
+            conn.close()
+
+    def _decode(self, response, body):
+        encoding = (response.getheader("content-encoding") or "").lower()
+        if encoding == "gzip":
+            return zlib.decompress(body, 16 + zlib.MAX_WBITS)
+        elif encoding == "deflate":
+            try:
+                return zlib.decompress(body)
+            except zlib.error:
+                return zlib.decompress(body, -zlib.MAX_WBITS)
+        return body
+
+    def get(self, query):
+        url = "{0}?{1}".format(self.path, query)
+
+        # a pooled connection may have been closed by the server while idle,
+        # so retry once on a fresh one before giving up
+        for attempt in range(2):
+            conn, reused = self._acquire()
+            try:
+                conn.request("GET", url, headers=self.headers)
+                response = conn.getresponse()
+                body = self._decode(response, response.read())
+            except (httplib.HTTPException, socket.error) as e:
+                conn.close()
+                if reused:
+                    continue
+                log.error("Error fetching {0}: {1}".format(url, e))
+                return None
+            except zlib.error as e:
+                conn.close()
+                log.error("Error decompressing {0}: {1}".format(url, e))
+                return None
+
+            if response.will_close:
+                conn.close()
+            else:
+                self._release(conn)
+
+            if response.status != 200:
+                log.warning("Upstream returned {0} for {1}".format(response.status, url))
+                return None
+            return body
+
+        return None
+
+    def fetch(self, coordinates):
+        return self.get("key=allow-all&ts=0&lat=" + str(coordinates[0]) + "&lng=" + str(coordinates[1]))
+
+    def close(self):
+        while True:
+            try:
+                self._pool.get_nowait().close()
+            except Queue.Empty:
+                break
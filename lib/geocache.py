@@ -0,0 +1,123 @@
+import os
+import re
+import json
+import time
+import logging
+import sqlite3
+import threading
+from collections import OrderedDict
+
+from lib.constants import _ROOT, _DEFAULT_GEOCODE_PRECISION, _DEFAULT_GEOCODE_CAPACITY, _DEFAULT_GEOCODE_TTL
+from lib.constants import _DEFAULT_BUSY_TIMEOUT
+
+log = logging.getLogger(__name__)
+
+_GEOCODE_DB = os.path.join(_ROOT, "db", "geocode.db")
+_PUNCTUATION = re.compile(r"[^\w\s]", re.UNICODE)
+
+class GeoCache(object):
+    """ LRU cache with a TTL in front of a SQLite table, so that geocoding
+        results survive restarts. Values are stored as JSON"""
+
+    def __init__(self, table, path=_GEOCODE_DB, capacity=_DEFAULT_GEOCODE_CAPACITY, ttl=_DEFAULT_GEOCODE_TTL):
+        self.table      = table
+        self.capacity   = int(capacity)
+        self.ttl        = float(ttl)
+        self.hits       = 0
+        self.misses     = 0
+
+        self._entries   = OrderedDict()     # key -> (stored, value)
+        self._lock      = threading.Lock()
+
+        db_dir = os.path.dirname(path)
+        if not os.path.exists(db_dir):
+            try:
+                os.makedirs(db_dir)
+            except:
+                log.error("Error in making {0}".format(db_dir))
+
+        # sharded workers each open the file, WAL lets them read while one writes
+        self._conn = sqlite3.connect(path, timeout=_DEFAULT_BUSY_TIMEOUT, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS {0} (key TEXT PRIMARY KEY, value TEXT NOT NULL, stored REAL NOT NULL)".format(self.table))
+        self._conn.execute("DELETE FROM {0} WHERE stored < ?".format(self.table), (time.time() - self.ttl,))
+        self._conn.commit()
+
+    def get(self, key):
+        now = time.time()
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None:
+                row = self._conn.execute("SELECT stored, value FROM {0} WHERE key = ?".format(self.table), (key,)).fetchone()
+                if row is not None:
+                    entry = (row[0], json.loads(row[1]))
+
+            if entry is None or now - entry[0] > self.ttl:
+                self.misses += 1
+                return None
+
+            self._entries[key] = entry
+            self._evict()
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key, value):
+        now = time.time()
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (now, value)
+            self._evict()
+            try:
+                self._conn.execute("INSERT OR REPLACE INTO {0} (key, value, stored) VALUES (?, ?, ?)".format(self.table), (key, json.dumps(value), now))
+                self._conn.commit()
+            except sqlite3.Error as e:
+                log.error("Error in storing {0} in {1}: {2}".format(key, self.table, e))
+
+    def stats(self):
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "hits":     self.hits,
+                "misses":   self.misses,
+                "size":     len(self._entries),
+                "hit_rate": float(self.hits) / total if total else 0.0,
+            }
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+    def _evict(self):
+        while len(self._entries) > self.capacity:
+            self._entries.popitem(last=False)
+
+class ReverseGeocodeCache(GeoCache):
+    """ Formatted addresses keyed by coordinates rounded to `precision` decimals"""
+
+    def __init__(self, precision=_DEFAULT_GEOCODE_PRECISION, **kwargs):
+        GeoCache.__init__(self, "reverse_geocode", **kwargs)
+        self.precision = int(precision)
+
+    def key(self, location):
+        return "{0:.{2}f},{1:.{2}f}".format(float(location[0]), float(location[1]), self.precision)
+
+class ForwardGeocodeCache(GeoCache):
+    """ Geocoding results keyed by the normalised address string. Only the
+        fields addlocation reads are kept"""
+
+    def __init__(self, **kwargs):
+        GeoCache.__init__(self, "forward_geocode", **kwargs)
+
+    def key(self, address):
+        # "20 Science Park Dr." and " 20 science park dr " share one entry
+        return " ".join(_PUNCTUATION.sub(" ", address.lower()).split())
+
+    def compact(self, geocode_result):
+        best_result = geocode_result[0]
+        return [{
+            "formatted_address": best_result["formatted_address"],
+            "geometry": {"location": {
+                "lat": best_result["geometry"]["location"]["lat"],
+                "lng": best_result["geometry"]["location"]["lng"],
+            }},
+        }]
@@ -0,0 +1,75 @@
+import logging
+import threading
+
+from lib.species import SPECIES
+
+log = logging.getLogger(__name__)
+
+class FilterIndex(object):
+    """ Which chats filter out which pokemon.
+
+        Each chat's filter list is a species bitset (see lib.species). While
+        its switch is on that bitset is also the chat's block mask, so whether
+        a chat hears about a sighting is one AND against the sighting's bit.
+        Species missing from the registry have no bit and are never blocked"""
+
+    def __init__(self, species=SPECIES):
+        self.species    = species
+        self._filters   = {}    # chatid -> bitset
+        self._switch    = {}    # chatid -> bool
+        self._blocked   = {}    # chatid -> bitset, only for chats with the switch on and a filter set
+        self._lock      = threading.Lock()
+
+    def filters(self, chatid):
+        return self._filters.get(int(chatid), 0)
+
+    def set_filters(self, chatid, bits, switch):
+        chatid = int(chatid)
+        with self._lock:
+            self._filters[chatid] = bits
+            self._switch[chatid] = bool(switch)
+            self._index(chatid)
+
+    def add(self, chatid, bits):
+        chatid = int(chatid)
+        with self._lock:
+            self._filters[chatid] = self._filters.get(chatid, 0) | bits
+            self._index(chatid)
+
+    def remove(self, chatid, bits):
+        chatid = int(chatid)
+        with self._lock:
+            self._filters[chatid] = self._filters.get(chatid, 0) & ~bits
+            self._index(chatid)
+
+    def set_switch(self, chatid, switch):
+        chatid = int(chatid)
+        with self._lock:
+            self._switch[chatid] = bool(switch)
+            self._index(chatid)
+
+    def drop(self, chatid):
+        chatid = int(chatid)
+        with self._lock:
+            self._filters.pop(chatid, None)
+            self._switch.pop(chatid, None)
+            self._blocked.pop(chatid, None)
+
+    def match(self, sightings, chatids):
+        """ {chatid: [sighting, ...]} of the sightings each chat should hear about,
+            in sighting order. Chats that filter out everything are left out"""
+        with self._lock:
+            chats = [(chatid, self._blocked.get(chatid, 0), []) for chatid in chatids]
+        for sighting in sightings:
+            bit = self.species.bit(sighting.name)
+            for chatid, blocked, delivered in chats:
+                if not blocked & bit:
+                    delivered.append(sighting)
+        return dict((chatid, delivered) for chatid, blocked, delivered in chats if delivered)
+
+    def _index(self, chatid):
+        bits = self._filters.get(chatid, 0)
+        if self._switch.get(chatid) and bits:
+            self._blocked[chatid] = bits
+        else:
+            self._blocked.pop(chatid, None)
@@ -0,0 +1,194 @@
+import time
+import bisect
+import logging
+import threading
+from contextlib import contextmanager
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+
+log = logging.getLogger(__name__)
+
+_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+def _labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join('{0}="{1}"'.format(k, v) for k, v in labels) + "}"
+
+class Counter(object):
+    def __init__(self):
+        self.value = 0
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+    def samples(self, name, labels):
+        return [(name, labels, self.value)]
+
+class Gauge(object):
+    """ A value read from `read()` whenever the metrics are collected"""
+
+    def __init__(self, read):
+        self.read = read
+
+    def samples(self, name, labels):
+        try:
+            value = self.read()
+        except Exception:
+            log.exception("Error reading {0}".format(name))
+            return []
+        return [(name, labels, value)]
+
+class Histogram(object):
+    def __init__(self, buckets=_BUCKETS):
+        self.buckets    = tuple(buckets)
+        self.counts     = [0] * (len(self.buckets) + 1)
+        self.sum        = 0.0
+        self.count      = 0
+        self._lock      = threading.Lock()
+
+    def observe(self, value):
+        with self._lock:
+            self.counts[bisect.bisect_left(self.buckets, value)] += 1
+            self.sum += value
+            self.count += 1
+
+    @contextmanager
+    def time(self):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.observe(time.time() - start)
+
+    def quantile(self, q):
+        """ Upper bound of the bucket the q-th quantile falls in"""
+        with self._lock:
+            if not self.count:
+                return 0.0
+            rank = q * self.count
+            seen = 0
+            for bound, count in zip(self.buckets, self.counts):
+                seen += count
+                if seen >= rank:
+                    return bound
+            return float("inf")
+
+    def samples(self, name, labels):
+        with self._lock:
+            counts, total, count = list(self.counts), self.sum, self.count
+        samples = []
+        cumulative = 0
+        for bound, bucket in zip(self.buckets + (float("inf"),), counts):
+            cumulative += bucket
+            samples.append((name + "_bucket", labels + (("le", "+Inf" if bound == float("inf") else repr(bound)),), cumulative))
+        samples.append((name + "_sum", labels, total))
+        samples.append((name + "_count", labels, count))
+        return samples
+
+class Registry(object):
+    """ Named metric families, each holding one metric per label set.
+
+        Asking for a metric that already exists returns it, so modules fetch
+        their metrics at import time and share them"""
+
+    def __init__(self):
+        self._families  = {}    # name -> (kind, help, {labels: metric})
+        self._lock      = threading.Lock()
+
+    def _get(self, kind, name, help, labels, factory):
+        labels = tuple(sorted(labels.items()))
+        with self._lock:
+            family = self._families.setdefault(name, (kind, help, {}))
+            metric = family[2].get(labels)
+            if metric is None:
+                metric = family[2][labels] = factory()
+            return metric
+
+    def counter(self, name, help, **labels):
+        return self._get("counter", name, help, labels, Counter)
+
+    def histogram(self, name, help, buckets=_BUCKETS, **labels):
+        return self._get("histogram", name, help, labels, lambda: Histogram(buckets))
+
+    def gauge(self, name, help, read, **labels):
+        """ Register read() as the gauge's value, replacing an earlier one"""
+        gauge = self._get("gauge", name, help, labels, lambda: Gauge(read))
+        gauge.read = read
+        return gauge
+
+    def collect(self):
+        """ (name, kind, help, [(sample name, labels, value), ...]) for every family"""
+        with self._lock:
+            families = [(name, kind, help, sorted(metrics.items())) for name, (kind, help, metrics) in sorted(self._families.items())]
+        return [(name, kind, help, [s for labels, metric in metrics for s in metric.samples(name, labels)])
+                for name, kind, help, metrics in families]
+
+    def render(self):
+        """ The Prometheus text exposition format"""
+        lines = []
+        for name, kind, help, samples in self.collect():
+            lines.append("# HELP {0} {1}".format(name, help))
+            lines.append("# TYPE {0} {1}".format(name, kind))
+            for sample, labels, value in samples:
+                lines.append("{0}{1} {2}".format(sample, _labels(labels), repr(float(value))))
+        return "\n".join(lines) + "\n"
+
+    def summary(self):
+        """ Short human readable digest for the /stats command"""
+        lines = []
+        with self._lock:
+            families = sorted(self._families.items())
+        for name, (kind, help, metrics) in families:
+            for labels, metric in sorted(metrics.items()):
+                label = name + _labels(labels)
+                if kind == "histogram":
+                    if metric.count:
+                        lines.append("{0}: n={1} avg={2:.3f}s p50<={3}s p95<={4}s".format(
+                            label, metric.count, metric.sum / metric.count, metric.quantile(0.5), metric.quantile(0.95)))
+                else:
+                    for sample, labels, value in metric.samples(name, labels):
+                        lines.append("{0}: {1}".format(label, value))
+        return "\n".join(lines)
+
+REGISTRY = Registry()
+
+# the stages of one scan cycle, from the upstream fetch to the Telegram send
+STAGES = dict((stage, REGISTRY.histogram("kopiradar_stage_seconds", "Time spent in each stage of a scan cycle", stage=stage))
+              for stage in ("fetch", "parse", "check_history", "get_location", "get_special_location", "db_write", "send"))
+
+class MetricsServer(object):
+    """ Serve registry.render() over HTTP on a background thread"""
+
+    def __init__(self, registry=REGISTRY, host="127.0.0.1", port=0):
+        self.registry = registry
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?")[0] not in ("/", "/metrics"):
+                    self.send_error(404)
+                    return
+                body = registry.render()
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                log.debug(format % args)
+
+        self._server = HTTPServer((host, int(port)), Handler)
+        self.port = self._server.server_address[1]
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, name="metrics")
+        self._thread.daemon = True
+        self._thread.start()
+        log.info("Serving metrics on port {0}".format(self.port))
+
+    def close(self):
+        self._server.shutdown()
+        self._server.server_close()
@@ -0,0 +1,129 @@
+""" Versioned in-place upgrades for db/kopiradar.db.
+
+    The schema version lives in SQLite's user_version pragma. A new database
+    is created at the latest version by Base.metadata.create_all and stamped;
+    an existing one runs every migration above its version. pysqlite commits
+    on its own around DDL and PRAGMAs, so migrations run on a connection in
+    autocommit mode under an explicit BEGIN and COMMIT, which also covers the
+    version bump. Run them explicitly with `python KopiRadar.py migrate`.
+"""
+import time
+import logging
+import sqlite3
+
+from lib.constants import _EXPIRE_FORMAT
+from lib.species import SPECIES
+
+log = logging.getLogger(__name__)
+
+def _history_expire(conn):
+    """ history.expire from the formatted display string to epoch seconds, plus history.seen"""
+    columns = dict((row[1], row[2]) for row in conn.execute("PRAGMA table_info(history)"))
+    if columns.get("expire", "").upper().startswith("INT") and "seen" in columns:
+        return
+
+    now = int(time.time())
+    rows = []
+    for hid, name, lat, lng, expire in conn.execute("SELECT id, name, lat, lng, expire FROM history"):
+        try:
+            expire = int(time.mktime(time.strptime(expire, _EXPIRE_FORMAT)))
+        except (TypeError, ValueError):
+            expire = 0
+        rows.append((hid, name, lat, lng, expire, now))
+
+    # build the new table alongside and rename it, so that chatid_history
+    # keeps pointing at "history"
+    conn.execute("CREATE TABLE history_new (id INTEGER NOT NULL PRIMARY KEY, name VARCHAR(255) NOT NULL, "
+                 "lat FLOAT NOT NULL, lng FLOAT NOT NULL, expire INTEGER NOT NULL, seen INTEGER NOT NULL)")
+    for row in rows:
+        conn.execute("INSERT INTO history_new (id, name, lat, lng, expire, seen) VALUES (?, ?, ?, ?, ?, ?)", row)
+    conn.execute("DROP TABLE history")
+    conn.execute("ALTER TABLE history_new RENAME TO history")
+    conn.execute("CREATE INDEX ix_history_expire ON history (expire)")
+    conn.execute("CREATE INDEX ix_history_seen ON history (seen)")
+
+def _dedupe(conn, table, columns, link_table, link_column):
+    """ Point links at the lowest id among rows equal on columns, then drop the rest"""
+    match = " AND ".join("a.{0} = b.{0}".format(c) for c in columns)
+    conn.execute("UPDATE {0} SET {1} = (SELECT MIN(a.id) FROM {2} a JOIN {2} b ON {3} WHERE b.id = {0}.{1}) "
+                 "WHERE {1} IN (SELECT id FROM {2})".format(link_table, link_column, table, match))
+    conn.execute("DELETE FROM {0} WHERE id NOT IN (SELECT MIN(id) FROM {0} GROUP BY {1})".format(table, ", ".join(columns)))
+    conn.execute("DELETE FROM {0} WHERE rowid NOT IN (SELECT MIN(rowid) FROM {0} GROUP BY chat_id, {1})".format(link_table, link_column))
+
+def _indexes(conn):
+    """ Unique keys for get-or-create and link tables, indexes for the hot lookups"""
+    _dedupe(conn, "filters", ("name",), "chatid_filters", "filter_id")
+    _dedupe(conn, "favs", ("name",), "chatid_favs", "fav_id")
+    _dedupe(conn, "locations", ("name", "lat", "lng"), "chatid_locations", "location_id")
+    _dedupe(conn, "history", ("name", "lat", "lng", "expire"), "chatid_history", "history_id")
+
+    for statement in (
+            "CREATE UNIQUE INDEX IF NOT EXISTS ux_filters_name ON filters (name)",
+            "CREATE UNIQUE INDEX IF NOT EXISTS ux_favs_name ON favs (name)",
+            "CREATE UNIQUE INDEX IF NOT EXISTS ux_locations ON locations (name, lat, lng)",
+            "CREATE UNIQUE INDEX IF NOT EXISTS ux_history ON history (name, lat, lng, expire)",
+            "CREATE UNIQUE INDEX IF NOT EXISTS ux_chatid_filters ON chatid_filters (chat_id, filter_id)",
+            "CREATE INDEX IF NOT EXISTS ix_chatid_filters_filter_id ON chatid_filters (filter_id)",
+            "CREATE UNIQUE INDEX IF NOT EXISTS ux_chatid_locations ON chatid_locations (chat_id, location_id)",
+            "CREATE INDEX IF NOT EXISTS ix_chatid_locations_location_id ON chatid_locations (location_id)",
+            "CREATE UNIQUE INDEX IF NOT EXISTS ux_chatid_favs ON chatid_favs (chat_id, fav_id)",
+            "CREATE INDEX IF NOT EXISTS ix_chatid_favs_fav_id ON chatid_favs (fav_id)",
+            "CREATE UNIQUE INDEX IF NOT EXISTS ux_chatid_history ON chatid_history (chat_id, history_id)",
+            "CREATE INDEX IF NOT EXISTS ix_chatid_history_history_id ON chatid_history (history_id)"):
+        conn.execute(statement)
+
+def _filter_bits(conn):
+    """ chatids.filter_bits, each chat's filters as one species bitset, filled from chatid_filters"""
+    columns = [row[1] for row in conn.execute("PRAGMA table_info(chatids)")]
+    if "filter_bits" not in columns:
+        conn.execute("ALTER TABLE chatids ADD COLUMN filter_bits BLOB")
+
+    names = {}
+    for chat_id, name in conn.execute("SELECT cf.chat_id, f.name FROM chatid_filters cf JOIN filters f ON f.id = cf.filter_id"):
+        names.setdefault(chat_id, []).append(name)
+    for chat_id, chat_names in names.iteritems():
+        # names outside the registry, typos in practice, cannot be stored as bits
+        bits, unknown = SPECIES.lookup(chat_names)
+        if unknown:
+            log.warning("Dropping unknown filters {0} of chat row {1}".format(", ".join(unknown), chat_id))
+        conn.execute("UPDATE chatids SET filter_bits = ? WHERE id = ?", (sqlite3.Binary(SPECIES.encode(bits)), chat_id))
+
+MIGRATIONS = [
+    (1, "history.expire as epoch seconds", _history_expire),
+    (2, "indexes and unique constraints", _indexes),
+    (3, "filters as a species bitset column", _filter_bits),
+]
+
+LATEST = MIGRATIONS[-1][0]
+
+def current_version(engine):
+    return engine.execute("PRAGMA user_version").scalar()
+
+def stamp(engine, version=LATEST):
+    engine.execute("PRAGMA user_version = {0}".format(int(version)))
+
+def upgrade(engine):
+    """ Run every migration above the database's version, returns the new version"""
+    version = current_version(engine)
+    raw = engine.raw_connection()
+    conn = raw.connection
+    isolation_level = conn.isolation_level
+    conn.isolation_level = None
+    try:
+        for target, description, migrate in MIGRATIONS:
+            if target <= version:
+                continue
+            log.info("Migrating database to version {0}: {1}".format(target, description))
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                migrate(conn)
+                conn.execute("PRAGMA user_version = {0}".format(target))
+                conn.execute("COMMIT")
+            except:
+                conn.execute("ROLLBACK")
+                raise
+            version = target
+    finally:
+        conn.isolation_level = isolation_level
+        raw.close()
+    return version
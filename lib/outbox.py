@@ -0,0 +1,291 @@
+import time
+import heapq
+import random
+import logging
+import threading
+
+from telegram.error import TelegramError, Unauthorized, BadRequest, TimedOut, NetworkError, ChatMigrated
+try:
+    from telegram.error import RetryAfter
+except ImportError:
+    RetryAfter = None
+
+from lib.constants import _MESSAGE_LIMIT, _DEFAULT_SEND_RATE, _DEFAULT_SEND_BURST, _DEFAULT_CHAT_RATE, _DEFAULT_CHAT_BURST
+from lib.constants import _DEFAULT_SEND_WORKERS, _DEFAULT_SEND_ATTEMPTS, _DEFAULT_SEND_RETRY_BASE, _DEFAULT_SEND_RETRY_MAX
+from lib.metrics import REGISTRY, STAGES
+
+_SENT       = REGISTRY.counter("kopiradar_messages_sent_total", "Telegram messages sent")
+_RETRIED    = REGISTRY.counter("kopiradar_send_retries_total", "Telegram sends retried after an error or flood control")
+_DROPPED    = REGISTRY.counter("kopiradar_send_dropped_total", "Telegram messages given up on")
+_DELIVERY   = dict((fast, REGISTRY.histogram("kopiradar_delivery_seconds", "Time from queueing a text to Telegram accepting it",
+                                             lane="fast" if fast else "normal"))
+                   for fast in (True, False))
+
+log = logging.getLogger(__name__)
+
+_SEPARATOR  = "\n\n"
+_SWEEP_SIZE = 1024
+
+class TokenBucket(object):
+    """ `rate` tokens a second, holding at most `burst` of them"""
+
+    def __init__(self, rate, burst, now=None):
+        self.rate       = float(rate)
+        self.burst      = float(burst)
+        self.tokens     = self.burst
+        self.updated    = now or time.time()
+
+    def _refill(self, now):
+        if now > self.updated:
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+
+    def delay(self, now=None):
+        """ Seconds until a token is available, 0 when one is available now"""
+        now = now or time.time()
+        self._refill(now)
+        if self.tokens >= 1.0:
+            return 0.0
+        return (1.0 - self.tokens) / self.rate
+
+    def take(self, now=None):
+        self._refill(now or time.time())
+        self.tokens -= 1.0
+
+    def full(self, now=None):
+        self._refill(now or time.time())
+        return self.tokens >= self.burst
+
+def take_chunk(parts, limit=_MESSAGE_LIMIT):
+    """ (text, rest): as many of `parts` as fit in one message of at most `limit`
+        characters, and what is left over. A single part that is too long on its
+        own is cut at the last line break that fits, or at `limit` if there is none"""
+    taken = []
+    size = 0
+    rest = list(parts)
+
+    while rest:
+        part = rest[0]
+        extra = len(part) + (len(_SEPARATOR) if taken else 0)
+        if size + extra <= limit:
+            taken.append(part)
+            size += extra
+            rest.pop(0)
+            continue
+
+        if not taken:
+            cut = part.rfind("\n", 0, limit + 1)
+            if cut <= 0:
+                cut = limit
+            taken.append(part[:cut])
+            rest[0] = part[cut:].lstrip("\n")
+            if not rest[0]:
+                rest.pop(0)
+        break
+
+    return _SEPARATOR.join(taken), rest
+
+class Outbox(object):
+    """ Deliver Telegram messages from a few sender threads, within a global
+        and a per-chat rate limit.
+
+        Texts queued for a chat that is waiting on its limit are merged into
+        as few messages as fit under Telegram's length limit. A send that
+        times out or hits a network error is retried with exponential backoff,
+        flood control is honoured, and chats that blocked the bot or reject
+        the message are dropped.
+
+        Texts sent with fast=True take a lane of their own: they are never
+        merged, and whenever both lanes have something due the fast one gets
+        the next global and per-chat token"""
+
+    def __init__(self, bot, rate=_DEFAULT_SEND_RATE, burst=_DEFAULT_SEND_BURST, chat_rate=_DEFAULT_CHAT_RATE,
+                 chat_burst=_DEFAULT_CHAT_BURST, workers=_DEFAULT_SEND_WORKERS, max_attempts=_DEFAULT_SEND_ATTEMPTS,
+                 retry_base=_DEFAULT_SEND_RETRY_BASE, retry_max=_DEFAULT_SEND_RETRY_MAX, limit=_MESSAGE_LIMIT):
+        self.bot            = bot
+        self.chat_rate      = float(chat_rate)
+        self.chat_burst     = float(chat_burst)
+        self.workers        = int(workers)
+        self.max_attempts   = int(max_attempts)
+        self.retry_base     = float(retry_base)
+        self.retry_max      = float(retry_max)
+        self.limit          = int(limit)
+
+        self._global    = TokenBucket(rate, burst)
+        # a chat has one bucket but a queue in each lane, keyed (chatid, fast)
+        self._buckets   = {}    # chatid -> TokenBucket
+        self._pending   = {}    # key -> list of texts not sent yet
+        self._since     = {}    # key -> the time each of those texts was queued
+        self._ready     = ([], [])  # fast and normal heaps of (due, seq, key) with pending texts
+        self._queued    = set() # keys on _ready or being sent to
+        self._attempts  = {}    # key -> failed attempts of its current message
+        self._seq       = 0
+        self._cond      = threading.Condition()
+        self._threads   = []
+        self._running   = False
+
+    def start(self):
+        self._running = True
+        for i in range(self.workers):
+            t = threading.Thread(target=self._worker, name="send-worker-{0}".format(i))
+            t.daemon = True
+            t.start()
+            self._threads.append(t)
+        log.info("Outbox started with {0} senders".format(self.workers))
+
+    def close(self, timeout=10.0):
+        """ Give the queue up to `timeout` seconds to drain, then stop the senders"""
+        deadline = time.time() + timeout
+        with self._cond:
+            while self._queued and self._threads and time.time() < deadline:
+                self._cond.wait(max(0.0, deadline - time.time()))
+            if self._queued:
+                log.warning("Dropping queued messages for {0} chats".format(len(self._queued)))
+            self._running = False
+            self._cond.notify_all()
+        for t in self._threads:
+            t.join()
+        self._threads = []
+
+    def send(self, chatid, text, fast=False):
+        key = (int(chatid), bool(fast))
+        now = time.time()
+        with self._cond:
+            self._pending.setdefault(key, []).append(text)
+            self._since.setdefault(key, []).append(now)
+            if key not in self._queued:
+                self._queued.add(key)
+                self._push(now, key)
+
+    def __len__(self):
+        with self._cond:
+            return sum(len(texts) for texts in self._pending.itervalues())
+
+    def _push(self, due, key):
+        self._seq += 1
+        heapq.heappush(self._ready[0 if key[1] else 1], (due, self._seq, key))
+        self._cond.notify_all()
+
+    def _bucket(self, chatid):
+        bucket = self._buckets.get(chatid)
+        if bucket is None:
+            bucket = self._buckets[chatid] = TokenBucket(self.chat_rate, self.chat_burst)
+        return bucket
+
+    def _next(self):
+        """ (key, text, queued_at) of the next message allowed out, None once stopped.
+            queued_at is when the oldest text in the message was queued"""
+        with self._cond:
+            while self._running:
+                now = time.time()
+                heads = [heap[0][0] for heap in self._ready if heap]
+                if not heads:
+                    self._cond.wait()
+                    continue
+                if min(heads) > now:
+                    self._cond.wait(min(heads) - now)
+                    continue
+
+                wait = self._global.delay(now)
+                if wait > 0:
+                    self._cond.wait(wait)
+                    continue
+
+                # the fast lane first, whenever it has a chat due
+                heap = [heap for heap in self._ready if heap and heap[0][0] <= now][0]
+                due, seq, key = heapq.heappop(heap)
+                bucket = self._bucket(key[0])
+                wait = bucket.delay(now)
+                if wait > 0:
+                    self._push(now + wait, key)
+                    continue
+
+                self._global.take(now)
+                bucket.take(now)
+                pending = self._pending[key]
+                if key[1]:
+                    text, rest = take_chunk(pending[:1], self.limit)
+                    rest += pending[1:]
+                else:
+                    text, rest = take_chunk(pending, self.limit)
+                # a part cut in two stays queued, so keeps its time
+                queued_at = self._since[key][0]
+                self._since[key] = self._since[key][len(pending) - len(rest):]
+                self._pending[key] = rest
+                return key, text, queued_at
+        return None
+
+    def _worker(self):
+        while True:
+            message = self._next()
+            if message is None:
+                break
+            key, text, queued_at = message
+            chatid, fast = key
+            delay = None
+            try:
+                with STAGES["send"].time():
+                    self.bot.sendMessage(chat_id=chatid, text=text)
+                _SENT.inc()
+                _DELIVERY[fast].observe(time.time() - queued_at)
+            except Exception as e:
+                delay = self._failed(key, text, e)
+                if delay is None:
+                    _DROPPED.inc()
+                else:
+                    _RETRIED.inc()
+            self._done(key, text, queued_at, delay)
+
+    def _failed(self, key, text, e):
+        """ Seconds to wait before retrying text, None to drop it"""
+        chatid, fast = key
+        if RetryAfter is not None and isinstance(e, RetryAfter):
+            log.warning("Flood control for {0}, retrying in {1}s".format(chatid, e.retry_after))
+            return e.retry_after
+        if isinstance(e, ChatMigrated):
+            log.info("Chat {0} migrated to {1}".format(chatid, e.new_chat_id))
+            self.send(e.new_chat_id, text, fast)
+            return None
+        if isinstance(e, (Unauthorized, BadRequest)):
+            log.warning("Dropping message for {0}: {1}".format(chatid, e))
+            return None
+        if isinstance(e, (TimedOut, NetworkError)):
+            attempts = self._attempts.get(key, 0) + 1
+            if attempts >= self.max_attempts:
+                log.error("Giving up on message for {0} after {1} attempts: {2}".format(chatid, attempts, e))
+                return None
+            self._attempts[key] = attempts
+            cap = min(self.retry_max, self.retry_base * (2 ** attempts))
+            delay = random.uniform(cap / 2.0, cap)
+            log.info("Sending to {0} failed ({1}), retrying in {2:.1f}s".format(chatid, e, delay))
+            return delay
+        if isinstance(e, TelegramError):
+            log.error("Dropping message for {0}: {1}".format(chatid, e))
+        else:
+            log.exception("Unexpected error sending to {0}".format(chatid))
+        return None
+
+    def _done(self, key, text, queued_at, delay):
+        with self._cond:
+            now = time.time()
+            if delay is not None:
+                self._pending[key].insert(0, text)
+                self._since[key].insert(0, queued_at)
+                self._push(now + delay, key)
+            elif self._pending[key]:
+                self._attempts.pop(key, None)
+                self._push(now, key)
+            else:
+                self._attempts.pop(key, None)
+                del self._pending[key]
+                del self._since[key]
+                self._queued.discard(key)
+                if len(self._buckets) > _SWEEP_SIZE:
+                    self._sweep(now)
+                self._cond.notify_all()
+
+    def _sweep(self, now):
+        # a full bucket is the same as a new one, so idle chats need not keep theirs
+        idle = lambda chatid: (chatid, True) not in self._queued and (chatid, False) not in self._queued
+        for chatid in [chatid for chatid, bucket in self._buckets.iteritems() if idle(chatid) and bucket.full(now)]:
+            del self._buckets[chatid]
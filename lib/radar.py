@@ -4,273 +4,359 @@ import logging
 import googlemaps
 import traceback
 import json
-import subprocess
 import time
+import Queue
 
-from ConfigParser import SafeConfigParser
 from datetime import datetime
 
 from telegram.ext import Updater
 from telegram.ext import CommandHandler
 from telegram.ext import MessageHandler, Filters
 from telegram.ext import Job
-from telegram.error import (TelegramError, Unauthorized, BadRequest, TimedOut,NetworkError)
 
 from lib.constants import _ROOT, _DEFAULT_LAT, _DEFAULT_LNG
+from lib.config import read_config, get_option
+from lib.constants import _DEFAULT_TILE_SIZE, _DEFAULT_SCAN_INTERVAL, _DEFAULT_MIN_INTERVAL, _DEFAULT_MAX_INTERVAL
+from lib.constants import _DEFAULT_IDLE_CYCLES, _DEFAULT_IDLE_BACKOFF, _DEFAULT_SCAN_JITTER, _DEFAULT_SCAN_TICK
+from lib.constants import _DEFAULT_EXPIRY_SETTLE, _DEFAULT_SPAWN_BUCKET, _DEFAULT_SPAWN_PHASES
+from lib.constants import _DEFAULT_FAV_INTERVAL, _DEFAULT_FAV_WINDOW
+from lib.constants import _UPSTREAM_URL, _DEFAULT_FETCH_TIMEOUT, _DEFAULT_POOL_SIZE
+from lib.constants import _DEFAULT_CONCURRENCY, _DEFAULT_BACKOFF_BASE, _DEFAULT_BACKOFF_MAX, _DEFAULT_MAX_ATTEMPTS
+from lib.constants import _DEFAULT_DRAIN_INTERVAL, _DEFAULT_LOG_PAYLOAD
+from lib.constants import _DEFAULT_GEOCODE_PRECISION, _DEFAULT_GEOCODE_CAPACITY, _DEFAULT_GEOCODE_TTL
+from lib.constants import _DEFAULT_PRUNE_INTERVAL, _DEFAULT_PRUNE_BATCH, _DEFAULT_PRUNE_PAUSE
+from lib.constants import _DEFAULT_RESULT_TTL, _DEFAULT_FETCH_LEASE
+from lib.constants import _DEFAULT_METRICS_HOST, _DEFAULT_METRICS_PORT
+from lib.constants import _DEFAULT_RECORD_FLUSH, _DEFAULT_REPLAY_SPEED
+from lib.constants import _DEFAULT_SEND_RATE, _DEFAULT_SEND_BURST, _DEFAULT_CHAT_RATE, _DEFAULT_CHAT_BURST
+from lib.constants import _DEFAULT_SEND_WORKERS, _DEFAULT_SEND_ATTEMPTS, _DEFAULT_SEND_RETRY_BASE, _DEFAULT_SEND_RETRY_MAX
+from lib.scheduler import TileScheduler
+from lib.fetcher import Fetcher
+from lib.engine import ScanEngine
+from lib.geocache import ReverseGeocodeCache, ForwardGeocodeCache
+from lib.dedup import AlertIndex
+from lib.subscriber import Subscriber
+from lib.sighting import parse_sightings
+from lib.matcher import FilterIndex
+from lib.species import SPECIES
+from lib.outbox import Outbox
+from lib.render import AlertRenderer
+from lib.tilecache import TileCache, SharedFetcher
+from lib.replay import Recorder, ReplayFetcher
+from lib.shard import shard_of, Update, Message, RELOAD_SPECIAL
+from lib.metrics import REGISTRY, STAGES, MetricsServer
 
 log = logging.getLogger(__name__)
 
+_ALERTS = REGISTRY.counter("kopiradar_alerts_total", "Sightings alerted to chats")
+_DUPLICATES = REGISTRY.counter("kopiradar_alert_duplicates_total", "Sightings a chat had already been alerted to")
+_EXPIRED = REGISTRY.counter("kopiradar_alert_expired_total", "Sightings skipped because they had already despawned")
+
 class Radar():
-	def __init__(self, database):
-		config = os.path.join(_ROOT, "conf", "KopiRadar.cfg")
-		parser = SafeConfigParser()
-		parser.read(config)
+	def __init__(self, database, shard=None):
+		parser = read_config()
 
 		log.info("Initialising Radar")
 
-		log.debug("Config read from {0}".format(config))
-
 		self.database   = database
+		self.shard      = shard	# (index, count) when running as one of several workers
 		self.updater	= Updater(token=parser.get('general', 'telegram_key'))
 		self.dispatcher = self.updater.dispatcher
 		self.gmaps	  = googlemaps.Client(key=parser.get('general', 'gmap_key'))
 
-		self.filters = {}
-		self.locations = {}
-		self.favs = {}
-		self.chatids = {}
-		self.filterswitch = {}
+		self.subscribers = {}	# chatid -> Subscriber
+		self.matcher = FilterIndex()
 		self.radius = 0.003
 
+		self.scan_interval = get_option(parser, 'radar', 'scan_interval', _DEFAULT_SCAN_INTERVAL)
+		self.prune_interval = get_option(parser, 'radar', 'prune_interval', _DEFAULT_PRUNE_INTERVAL)
+		self.prune_batch = get_option(parser, 'radar', 'prune_batch', _DEFAULT_PRUNE_BATCH)
+		self.prune_pause = get_option(parser, 'radar', 'prune_pause', _DEFAULT_PRUNE_PAUSE)
+		self.scan_tick = get_option(parser, 'radar', 'scan_tick', _DEFAULT_SCAN_TICK)
+		self.scheduler = TileScheduler(
+			get_option(parser, 'radar', 'tile_size', _DEFAULT_TILE_SIZE),
+			self.scan_interval,
+			get_option(parser, 'radar', 'min_interval', _DEFAULT_MIN_INTERVAL),
+			get_option(parser, 'radar', 'max_interval', _DEFAULT_MAX_INTERVAL),
+			get_option(parser, 'radar', 'idle_cycles', _DEFAULT_IDLE_CYCLES),
+			get_option(parser, 'radar', 'idle_backoff', _DEFAULT_IDLE_BACKOFF),
+			get_option(parser, 'radar', 'scan_jitter', _DEFAULT_SCAN_JITTER),
+			get_option(parser, 'radar', 'expiry_settle', _DEFAULT_EXPIRY_SETTLE),
+			get_option(parser, 'radar', 'spawn_bucket', _DEFAULT_SPAWN_BUCKET),
+			get_option(parser, 'radar', 'spawn_phases', _DEFAULT_SPAWN_PHASES),
+			get_option(parser, 'radar', 'fav_interval', _DEFAULT_FAV_INTERVAL),
+			get_option(parser, 'radar', 'fav_window', _DEFAULT_FAV_WINDOW))
+		replay_file = get_option(parser, 'upstream', 'replay', "")
+		record_file = get_option(parser, 'upstream', 'record', "")
+		if replay_file:
+			self.fetcher = ReplayFetcher(replay_file, get_option(parser, 'upstream', 'replay_speed', _DEFAULT_REPLAY_SPEED))
+		else:
+			self.fetcher = Fetcher(
+				get_option(parser, 'upstream', 'url', _UPSTREAM_URL),
+				get_option(parser, 'upstream', 'timeout', _DEFAULT_FETCH_TIMEOUT),
+				get_option(parser, 'upstream', 'pool_size', _DEFAULT_POOL_SIZE))
+		if record_file:
+			# shards record side by side, one gzip stream cannot take two writers
+			if self.shard != None:
+				record_file = "{0}.{1}".format(record_file, self.shard[0])
+			self.fetcher = Recorder(self.fetcher, record_file, get_option(parser, 'upstream', 'record_flush', _DEFAULT_RECORD_FLUSH))
+		shards = 1
+		self.upstream = self.fetcher
+		if self.shard != None:
+			shards = self.shard[1]
+			# other shards scan the same tiles, share what any of them fetched
+			# a result must outlive the gap between two shards' scans of one tile
+			result_ttl = max(get_option(parser, 'shard', 'result_ttl', _DEFAULT_RESULT_TTL), self.scheduler.min_interval)
+			self.upstream = SharedFetcher(self.fetcher, TileCache(ttl=result_ttl),
+				get_option(parser, 'shard', 'fetch_lease', _DEFAULT_FETCH_LEASE))
+		self.engine = ScanEngine(self.upstream,
+			get_option(parser, 'upstream', 'concurrency', _DEFAULT_CONCURRENCY),
+			get_option(parser, 'upstream', 'backoff_base', _DEFAULT_BACKOFF_BASE),
+			get_option(parser, 'upstream', 'backoff_max', _DEFAULT_BACKOFF_MAX),
+			get_option(parser, 'upstream', 'max_attempts', _DEFAULT_MAX_ATTEMPTS),
+			get_option(parser, 'upstream', 'log_payload', _DEFAULT_LOG_PAYLOAD))
+		# the global limit is split between the shards, the per-chat one is not since a chat lives in one shard
+		self.outbox = Outbox(self.updater.bot,
+			get_option(parser, 'telegram', 'rate', _DEFAULT_SEND_RATE) / shards,
+			max(1, get_option(parser, 'telegram', 'burst', _DEFAULT_SEND_BURST) / shards),
+			get_option(parser, 'telegram', 'chat_rate', _DEFAULT_CHAT_RATE),
+			get_option(parser, 'telegram', 'chat_burst', _DEFAULT_CHAT_BURST),
+			get_option(parser, 'telegram', 'workers', _DEFAULT_SEND_WORKERS),
+			get_option(parser, 'telegram', 'max_attempts', _DEFAULT_SEND_ATTEMPTS),
+			get_option(parser, 'telegram', 'retry_base', _DEFAULT_SEND_RETRY_BASE),
+			get_option(parser, 'telegram', 'retry_max', _DEFAULT_SEND_RETRY_MAX))
+		self.reverse_cache = ReverseGeocodeCache(
+			precision=get_option(parser, 'geocode', 'precision', _DEFAULT_GEOCODE_PRECISION),
+			capacity=get_option(parser, 'geocode', 'capacity', _DEFAULT_GEOCODE_CAPACITY),
+			ttl=get_option(parser, 'geocode', 'ttl', _DEFAULT_GEOCODE_TTL))
+		self.forward_cache = ForwardGeocodeCache(
+			capacity=get_option(parser, 'geocode', 'capacity', _DEFAULT_GEOCODE_CAPACITY),
+			ttl=get_option(parser, 'geocode', 'ttl', _DEFAULT_GEOCODE_TTL))
+
 		#initialise with existing chat ids first#
 		log.info("Initialising information in Database")
-		chatids = self.database.get_all_chatid()
-
-		for x in chatids:
-			locations   = self.database.get_locations_by_chatid(x)
-			filters	 = self.database.get_filters_by_chatid(x)
-			favs		= self.database.get_favs_by_chatid(x)
-
-			self.filters[int(x)] = []
-			self.locations[int(x)] = []
-			self.favs[int(x)] = []
-			self.chatids[int(x)] = ()
-
-			for y in locations:
-				self.locations[int(x)].append((y.name, y.lat, y.lng))
-			for y in filters:
-				self.filters[int(x)].append(y.name)
-			for y in favs:
-				self.favs[int(x)].append(y.name)
-
-			self.chatids[int(x)] = self.database.get_currentlocation(x)
-			self.filterswitch[int(x)] = self.database.get_filterswitch(x)
-
-		log.debug("chatids: {0}".format(self.chatids))
-		log.debug("filters: {0}".format(self.filters))
-		log.debug("favs: {0}".format(self.favs))
-		log.debug("locations: {0}".format(self.locations))
-		log.debug("filterswitch: {0}".format(self.filterswitch))
+		log.info("Filtering against {0} species".format(len(SPECIES)))
+		for x, lat, lng, filter_switch, filters, locations, favs in self.database.get_all_chat_states():
+			if self.shard != None and shard_of(x, shards) != self.shard[0]:
+				continue
+			self.subscribers[x] = Subscriber(x, lat, lng, filter_switch, filters, locations, SPECIES.lookup(favs)[0])
+			self.matcher.set_filters(x, filters, filter_switch)
+			self.scheduler.subscribe(x, lat, lng)
+
+		self.scheduler.spread()
+		log.info("{0} chats spread over {1} tiles".format(len(self.subscribers), len(self.scheduler.tiles)))
+
+		self.alerts = AlertIndex()
+		self.alerts.load(row for row in self.database.get_all_history() if row[0] in self.subscribers)
+		self.renderer = AlertRenderer(self._get_location, self._get_special_location)
+
+		# chat ids allowed to use /stats
+		self.admins = set(int(x) for x in get_option(parser, 'metrics', 'admins', "").replace(",", " ").split())
+		self.metrics_server = None
+		self.metrics_port = None
+		self.metrics_host = get_option(parser, 'metrics', 'host', _DEFAULT_METRICS_HOST)
+		port = get_option(parser, 'metrics', 'port', _DEFAULT_METRICS_PORT)
+		if port > 0:
+			# each shard serves its own numbers on the next port up
+			self.metrics_port = port + (self.shard[0] if self.shard != None else 0)
+		self._register_gauges()
 
 	def _help(self, bot, update):
 		start_message = "Welcome to KopiRadar (Alpha 0.6)\n"
 		start_message += "You don't have to do anything to start\n"
 		log.info("Hello {0}".format(update.message.chat_id))
-		bot.sendMessage(chat_id=update.message.chat_id, text=start_message)
-
-	def _process_result(self, chatid, results, filtered_pokemons, filterswitch):
-		message = ""
-		summaries = ""
-		data = results["result"]
-
-		for r in data:
-			pokemon = None
-
-			# get the name of the pokemon
-			if "pokemon_id" in r:
-				pokemon = r["pokemon_id"]
-			elif "lure_info" in r:
-				if "active_pokemon_id" in r["lure_info"]:
-					pokemon = r["lure_info"]["active_pokemon_id"]
-
-			log.info(filtered_pokemons)
-			log.info(filterswitch)
-			# process the information
-			if pokemon == None:
-				continue
-			elif pokemon.lower() in filtered_pokemons and filterswitch == True:
-				log.debug("---{0} is in filter list".format(pokemon.lower()))
-
-				pokemon_latitude 	= r['latitude']
-				pokemon_longitude 	= r['longitude']
-
-				#history.write("{0} appears in ({1},{2})\n".format(pokemon, str(pokemon_latitude), str(pokemon_longitude)))
-			else:
-				pokemon_latitude 	= None
-				pokemon_longitude 	= None
-				pokemon_expire 		= None
-
-				if "latitude" in r:
-					pokemon_latitude 	= r['latitude']
-					pokemon_longitude 	= r['longitude']
-					pokemon_location	= (float(pokemon_latitude),float(pokemon_longitude))
-				else:
-					continue
-
-				if "expiration_timestamp_ms" in r:
-					pokemon_expire = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(int(r["expiration_timestamp_ms"])/1000))
-				else:
-					# self.database.add_history(chatid, pokemon, pokemon_latitude, pokemon_longitude, pokemon_expire)
-					pokemon_expire = "Can't Find Expire Time"
-
-				log.info("Checking {0} {1}".format(pokemon, pokemon_expire))
-
-				if self.database.check_history(chatid, pokemon, float(pokemon_latitude), float(pokemon_longitude), str(pokemon_expire)):
-					log.info("Already alarmed the user about this pokemon: {0}".format(pokemon))
-				else:
-					self.database.add_history(chatid, pokemon, pokemon_latitude, pokemon_longitude, str(pokemon_expire))
-					log.info("Added history to Database")
-
-					location_by_name 	= self._get_location(pokemon_location)
-					special_location 	= self._get_special_location(pokemon_location)
-					location_by_gmap 	= "https://www.google.com/maps/place/" + str(pokemon_location[0]) + "," + str(pokemon_location[1])
-
-					message += "{0}: {1}\n{2}\n{3}\n".format(pokemon, pokemon_expire,location_by_name, location_by_gmap)
-					if special_location != False:
-						message += "{0}\n\n".format(special_location.upper())
-					else:
-						message += "({0},{1})\n\n".format(str(pokemon_location[0]), str(pokemon_location[1]))
-
-					summaries += pokemon.upper()
-					summaries += " "
-
-		log.info("-- {0}".format(message))
-
-		if message == "":
-			final_message = None
-		else:
-			final_message = summaries + "\n\n" + message
-
-		return final_message
-
-	def _query_data(self, chatid, coordinates):
-		data = None
-		message = None
-		chatid = int(chatid)
-		while data == None or "result" not in data:
-			curl_args = ['curl', "https://api.fastpokemap.se/?key=allow-all&ts=0&lat=" + str(coordinates[0]) + "&lng=" + str(coordinates[1]), "-H", "origin: https://fastpokemap.se", "-H", "user-agent: Mozilla/5.0 (Windows NT 6.1) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/41.0.2228.0 Safari/537.36", "-H", 'authority: api.fastpokemap.se', "--compressed"]
-			response = subprocess.check_output(curl_args)
-			if response == None or response == "":
-				time.sleep(5)
+		self.outbox.send(update.message.chat_id, start_message)
+
+	def _process_result(self, chatid, sightings):
+		now = time.time()
+		fresh = []
+		pending = set()
+
+		for sighting in sightings:
+			pokemon = sighting.pokemon
+			log.debug("Checking {0} {1}".format(pokemon, sighting.expire))
+
+			with STAGES["check_history"].time():
+				alert = self.alerts.key(chatid, pokemon, sighting.lat, sighting.lng, sighting.expires_at or 0)
+				seen = alert in pending or self.alerts.contains(alert, now)
+			if seen:
+				_DUPLICATES.inc()
+				log.debug("Already alarmed the user about this pokemon: {0}".format(pokemon))
+			elif sighting.expires_at and sighting.expires_at <= now:
+				# the index will not hold a despawned sighting, so alerting it would repeat on every scan
+				_EXPIRED.inc()
+				log.debug("Skipping {0}, it expired at {1}".format(pokemon, sighting.expire))
 			else:
-				log.info("response: {0}".format(response))
-				data = json.loads(response)
-
-				if data == None:
-					time.sleep(5)
-				elif "result" not in data:
-					log.info("Server is currently overloaded. Let's wait for 5 seconds: {0}".format(data))
-					time.sleep(5)
-				else:
-					tfilter_switch = self.filterswitch[chatid]
-					filtered_pokemons = []
-					if chatid in self.filters:
-						filtered_pokemons = self.filters[chatid]
-					else:
-						filtered_pokemons = []
-
-					#chatid, results, filtered_pokemons, filterswitch
-					message = self._process_result(chatid, data, filtered_pokemons, tfilter_switch)
-
-					if message != None:
-						log.info("Done! Reply to our user...")
-						#bot.sendMessage(chat_id=chatid, text=message)
-						return message
-					else:
-						return None
-
-	def _watch(self, bot, job):
-		timer 		= 300.0
-		coordinates = None
-		location 	= None # location in coordinates
-
-		if int(job.context) in self.chatids:
-			coordinates = float(self.chatids[job.context][0]), float(self.chatids[job.context][1])
-			location = self._get_location(coordinates)
-		else:
-			self.update_chatid(job.context, _DEFAULT_LAT, _DEFAULT_LNG)
-			self.favs[int(x)]	   = []
-			self.filters[int(x)]	= []
-			self.locations[int(x)]  = []
-
-			log.info("Done initialising for new chatid #{0}".format(job.context))
-			coordinates = (_DEFAULT_LAT, _DEFAULT_LNG)
-			location = _DEFAULT_NAME
-
-		if location == None:
-			log.error("Could not get/create any location")
+				pending.add(alert)
+				fresh.append((alert, sighting))
+
+		# rendered first, a sighting only counts as alerted once there is a message for it
+		message = self.renderer.message([sighting for alert, sighting in fresh])
+		for alert, sighting in fresh:
+			self.alerts.add(alert, sighting.expires_at, now)
+			self.database.add_history(chatid, sighting.pokemon, sighting.lat, sighting.lng, sighting.expires_at or 0)
+
+		_ALERTS.inc(len(fresh))
+		return message
+
+	def _scan_tiles(self, bot, job):
+		tiles = self.scheduler.due()
+		if not tiles:
+			return
+
+		log.info("Scanning {0} of {1} tiles for {2} chats".format(len(tiles), len(self.scheduler.tiles), len(self.subscribers)))
+		log.debug("Reverse geocode cache: {0}".format(self.reverse_cache.stats()))
+		log.debug("Forward geocode cache: {0}".format(self.forward_cache.stats()))
+
+		for tile in tiles:
+			self.engine.submit(tile, self.scheduler.center_of(tile))
+
+	def _drain_results(self, bot, job):
+		# fragments are only reused within a tick, so expiry and special locations stay current
+		self.renderer.reset()
+		while True:
+			try:
+				tile, coordinates, records = self.engine.results.get_nowait()
+			except Queue.Empty:
+				break
 
-		message = self._query_data(job.context, coordinates)
+			# only the usable sightings are kept, the raw records are parsed and dropped one by one
+			with STAGES["parse"].time():
+				sightings = list(parse_sightings(records))
+			self.scheduler.observe(tile, sightings)
+			chats = [chatid for chatid in self.scheduler.subscribers(tile) if chatid in self.subscribers]
+
+			for chatid, delivered in self.matcher.match(sightings, chats).iteritems():
+				# one chat failing, say on a geocoding error, must not cost the others on the tile their alerts
+				try:
+					self._alert_chat(tile, chatid, delivered)
+				except Exception:
+					log.exception("Error alerting chat {0} about tile {1}".format(chatid, tile))
+
+	def _alert_chat(self, tile, chatid, sightings):
+		favs = self.subscribers[chatid].favs
+		if favs:
+			sightings = self._send_favourites(tile, chatid, favs, sightings)
+		message = self._process_result(chatid, sightings)
 		if message != None:
-			bot.sendMessage(chat_id=job.context, text=message)
+			log.info("Done! Queueing reply to our user...")
+			self.outbox.send(chatid, message)
+
+	def _send_favourites(self, tile, chatid, favs, sightings):
+		""" Send each of the chat's favourites among sightings as a message of its
+			own on the outbox's fast lane, returns the other sightings"""
+		rest = []
+		for sighting in sightings:
+			if not SPECIES.bit(sighting.name) & favs:
+				rest.append(sighting)
+				continue
+			# a favourite keeps its area on the fast scan cadence for a while
+			self.scheduler.hasten(tile)
+			message = self._process_result(chatid, [sighting])
+			if message != None:
+				log.info("Favourite {0} for {1}, queueing it ahead".format(sighting.pokemon, chatid))
+				self.outbox.send(chatid, message, fast=True)
+		return rest
+
+	def _prune_history(self, bot, job):
+		# jobs run on the scan thread, so one batch at a time with the scans going on in between
+		if self.database.prune_history(self.prune_batch) >= self.prune_batch:
+			self.updater.job_queue.put(Job(self._prune_history, self.prune_pause, repeat=False))
 
 	def addfilter(self, bot, update, args):
 		if len(args) < 1:
-			bot.sendMessage(chat_id=update.message.chat_id, text="Perhaps you can give us a pokemon name. /addfilter pidgey rattata")
+			self.outbox.send(update.message.chat_id, "Perhaps you can give us a pokemon name. /addfilter pidgey rattata")
 		else:
-			message = "Added:\n"
-			x_list = []
-			for x in args:
-				pokemon = x.rstrip().lower()
-				message += "- {0}\n".format(pokemon)
-				x_list.append(pokemon)
-
-			self._add_filter(update.message.chat_id, x_list)
-			bot.sendMessage(chat_id=update.message.chat_id, text=message)
+			bits, unknown = SPECIES.lookup(x.rstrip() for x in args)
+			message = ""
+			if bits:
+				message += "Added:\n"
+				for pokemon in SPECIES.names_of(bits):
+					message += "- {0}\n".format(pokemon)
+				self._add_filter(update.message.chat_id, bits)
+			message += self._unknown_species(unknown)
+			self.outbox.send(update.message.chat_id, message)
 
 	def removefilter(self, bot, update, args):
 		if len(args) < 1:
-			bot.sendMessage(chat_id=update.message.chat_id, text="Perhaps you can give us a name")
+			self.outbox.send(update.message.chat_id, "Perhaps you can give us a name")
 		else:
-			message = "Removed:\n"
-			x_remove = []
-			for x in args:
-				pokemon = x.rstrip().lower()
-				x_remove.append(pokemon)
-				message+= "- {0}\n".format(pokemon)
-			self._remove_filter(update.message.chat_id, x_remove)
-			bot.sendMessage(chat_id=update.message.chat_id, text=message)
+			bits, unknown = SPECIES.lookup(x.rstrip() for x in args)
+			message = ""
+			if bits:
+				message += "Removed:\n"
+				for pokemon in SPECIES.names_of(bits):
+					message += "- {0}\n".format(pokemon)
+				self._remove_filter(update.message.chat_id, bits)
+			message += self._unknown_species(unknown)
+			self.outbox.send(update.message.chat_id, message)
 
 	def showfilter(self, bot, update):
 		message = ""
 
-		if update.message.chat_id not in self.filters:
-			self.filters[update.message.chat_id] = []
-			bot.sendMessage(chat_id=update.message.chat_id, text="You don't have a filter list yet. Start by using /addfilter")
+		if update.message.chat_id not in self.subscribers:
+			self.outbox.send(update.message.chat_id, "You don't have a filter list yet. Start by using /addfilter")
+		else:
+			message = "\n".join(SPECIES.names_of(self.subscribers[update.message.chat_id].filters))
+
+			if message == "":
+				message = "No pokemon yet."
+			self.outbox.send(update.message.chat_id, message)
+
+	def addfav(self, bot, update, args):
+		if len(args) < 1:
+			self.outbox.send(update.message.chat_id, "Perhaps you can give us a pokemon name. /addfav dragonite snorlax")
+		else:
+			bits, unknown = SPECIES.lookup(x.rstrip() for x in args)
+			message = ""
+			if bits:
+				message += "Added to favourites:\n"
+				for pokemon in SPECIES.names_of(bits):
+					message += "- {0}\n".format(pokemon)
+				self._add_fav(update.message.chat_id, bits)
+			message += self._unknown_species(unknown)
+			self.outbox.send(update.message.chat_id, message)
+
+	def removefav(self, bot, update, args):
+		if len(args) < 1:
+			self.outbox.send(update.message.chat_id, "Perhaps you can give us a name")
+		else:
+			bits, unknown = SPECIES.lookup(x.rstrip() for x in args)
+			message = ""
+			if bits:
+				message += "Removed from favourites:\n"
+				for pokemon in SPECIES.names_of(bits):
+					message += "- {0}\n".format(pokemon)
+				self._remove_fav(update.message.chat_id, bits)
+			message += self._unknown_species(unknown)
+			self.outbox.send(update.message.chat_id, message)
+
+	def showfav(self, bot, update):
+		if update.message.chat_id not in self.subscribers:
+			self.outbox.send(update.message.chat_id, "You don't have favourites yet. Start by using /addfav")
 		else:
-			for l in self.filters[update.message.chat_id]:
-				message += l
-				if l != self.filters[update.message.chat_id][-1]:
-					message += "\n"
+			message = "\n".join(SPECIES.names_of(self.subscribers[update.message.chat_id].favs))
 
-			if len( self.filters[update.message.chat_id]) == 0:
+			if message == "":
 				message = "No pokemon yet."
-			bot.sendMessage(chat_id=update.message.chat_id, text=message)
+			self.outbox.send(update.message.chat_id, message)
 
 	def filterswitchf(self, bot, update, args):
 		switch = False
 		if len(args) < 1:
-			bot.sendMessage(chat_id=update.message.chat_id, text="Turn on by /filteron 1. Turn off by using /filteron 0")
+			self.outbox.send(update.message.chat_id, "Turn on by /filteron 1. Turn off by using /filteron 0")
 		elif int(args[0]) == 1:
 			switch = True
 		self.database.update_filter_switch(update.message.chat_id, switch)
-		self.filterswitch[update.message.chat_id] = switch
+		if update.message.chat_id in self.subscribers:
+			self.subscribers[update.message.chat_id].filterswitch = switch
+			self.matcher.set_switch(update.message.chat_id, switch)
 		message = "Updated Filter Switch: {0}".format(switch)
-		bot.sendMessage(chat_id=update.message.chat_id, text=message)
+		self.outbox.send(update.message.chat_id, message)
 
 	def addlocation(self, bot, update, args):
 		if len(args) < 1:
-			bot.sendMessage(chat_id=update.message.chat_id, text="Perhaps you can give us a location. /addlocation sp20 20 Science Park Drive")
+			self.outbox.send(update.message.chat_id, "Perhaps you can give us a location. /addlocation sp20 20 Science Park Drive")
 		else:
 			message = ""
 
@@ -284,7 +370,7 @@ class Radar():
 			google_location = self._get_location_by_name(user_location)
 
 			if google_location == None:
-				bot.sendMessage(chat_id=update.message.chat_id, text="We can't find this address. Perhaps you can add more details? (e.g street or blk number)")
+				self.outbox.send(update.message.chat_id, "We can't find this address. Perhaps you can add more details? (e.g street or blk number)")
 			else:
 				best_result 		= google_location[0]
 				formatted_address 	= None
@@ -300,46 +386,43 @@ class Radar():
 				if formatted_address:
 					self._add_location(update.message.chat_id, name, float(lat), float(lon))
 					message = "Added to location list:\n{0} as {1}".format(formatted_address, name)
-					bot.sendMessage(chat_id=update.message.chat_id, text=message)
+					self.outbox.send(update.message.chat_id, message)
 				else:
-					bot.sendMessage(chat_id=update.message.chat_id, text="We can't get enough info for this address.")
+					self.outbox.send(update.message.chat_id, "We can't get enough info for this address.")
 
 	def removelocation(self, bot, update, args):
 		if len(args) < 1:
-			bot.sendMessage(chat_id=update.message.chat_id, text="Perhaps you can give us a location. /removelocation sp20")
+			self.outbox.send(update.message.chat_id, "Perhaps you can give us a location. /removelocation sp20")
 		else:
 			log.info("Removing location {0}".format(args[0]))
 			self._remove_location(update.message.chat_id, args[0])
 			message = "Removed {0} from location list\n".format(args[0])
-			bot.sendMessage(chat_id=update.message.chat_id, text=message)
+			self.outbox.send(update.message.chat_id, message)
 
 	def showlocation(self, bot, update):
 		message = ""
 		index = 0
 
-		if update.message.chat_id not in self.chatids:
+		if update.message.chat_id not in self.subscribers:
 			message += "Cannot find your chat_id. Weird."
-
-		if self.locations[update.message.chat_id] == []:
+		elif len(self.subscribers[update.message.chat_id].locations) == 0:
 			message += "You have not added any locations yet"
 		else:
-			locations = self.locations[int(update.message.chat_id)]
-			for l in locations:
-				print l
+			for l in self.subscribers[update.message.chat_id].locations:
 				message += "{0}. {1} ({2}, {3})\n".format(index, l[0], l[1],  l[2])
 				index = index + 1
 
-		bot.sendMessage(chat_id=update.message.chat_id, text=message)
+		self.outbox.send(update.message.chat_id, message)
 
 	def setlocation(self, bot, update, args):
 		if len(args) < 1:
-			bot.sendMessage(chat_id=update.message.chat_id, text="Perhaps you can give us a location. /setlocation sp20")
+			self.outbox.send(update.message.chat_id, "Perhaps you can give us a location. /setlocation sp20")
 		else:
 			user_location = args[0]
-			locations = self.locations[int(update.message.chat_id)]
+			subscriber = self.subscribers[int(update.message.chat_id)]
 			lat = 0
 			lng = 0
-			for location in locations:
+			for location in subscriber.locations:
 				if location[0].lower() == user_location.lower():
 					lat = float(location[1])
 					lng = float(location[2])
@@ -352,17 +435,15 @@ class Radar():
 				message += "Update current location to {0} {1},{2}".format(user_location, lat, lng)
 
 			self.database.update_current_location(update.message.chat_id, lat, lng)
-			self.chatids[int(update.message.chat_id)] = (float(lat), float(lng))
-			bot.sendMessage(chat_id=update.message.chat_id, text=message)
+			subscriber.move(lat, lng)
+			tile = self.scheduler.subscribe(update.message.chat_id, lat, lng)
+			self.outbox.send(update.message.chat_id, message)
 			log.debug("Current location for {0} is {1} {2}".format(update.message.chat_id, lat, lng))
-			m = self._query_data(update.message.chat_id, (float(lat), float(lng)))
-
-			if m != None:
-				bot.sendMessage(chat_id=update.message.chat_id, text=m)
+			self.engine.submit(tile, self.scheduler.center_of(tile))
 
 	def addspeciallocation(self, bot, update, args):
 		if len(args) < 3:
-			bot.sendMessage(chat_id=update.message.chat_id, text="/addspeciallocation name lat lng")
+			self.outbox.send(update.message.chat_id, "/addspeciallocation name lat lng")
 		else:
 			message = ""
 
@@ -383,14 +464,14 @@ class Radar():
 			else:
 				message += "Added {0} to Special Location List".format(name)
 
-			bot.sendMessage(chat_id=update.message.chat_id, text=message)
+			self.outbox.send(update.message.chat_id, message)
 
 	def removespeciallocation(self, bot, update, args):
 		if len(args) < 1:
-			bot.sendMessage(chat_id=update.message.chat_id, text="/removespeciallocation name")
+			self.outbox.send(update.message.chat_id, "/removespeciallocation name")
 		else:
-			self.database.remove_speciallocation(name)
-			bot.sendMessage(chat_id=update.message.chat_id, text="Removed")
+			self.database.remove_speciallocation(args[0])
+			self.outbox.send(update.message.chat_id, "Removed")
 
 	def showspeciallocation(self, bot, update):
 		specials = self.database.get_all_speciallocation()
@@ -401,118 +482,224 @@ class Radar():
 		if len(specials) == 0:
 			message += "No special location has been added."
 
-		bot.sendMessage(chat_id=update.message.chat_id, text=message)
-
-	def start(self):
-		# test
-		help_handler = CommandHandler('help', self._help)
-		self.dispatcher.add_handler(help_handler)
+		self.outbox.send(update.message.chat_id, message)
 
-		# Location Relevance #
-		addlocation_handler = CommandHandler("addlocation", self.addlocation, pass_args=True)
-		self.dispatcher.add_handler(addlocation_handler)
+	def stats(self, bot, update):
+		if int(update.message.chat_id) not in self.admins:
+			self.outbox.send(update.message.chat_id, "This command is for admins only.")
+			return
 
-		removelocation_handler = CommandHandler("removelocation", self.removelocation, pass_args=True)
-		self.dispatcher.add_handler(removelocation_handler)
+		message = REGISTRY.summary()
+		if self.shard != None:
+			message = "Shard {0} of {1}\n{2}".format(self.shard[0], self.shard[1], message)
+		self.outbox.send(update.message.chat_id, message)
 
-		showlocation_handler = CommandHandler("showlocation", self.showlocation)
-		self.dispatcher.add_handler(showlocation_handler)
-
-		setlocation_handler = CommandHandler("setlocation", self.setlocation, pass_args=True)
-		self.dispatcher.add_handler(setlocation_handler)
-
-		addspeciallocation_handler = CommandHandler("addspeciallocation", self.addspeciallocation, pass_args=True)
-		self.dispatcher.add_handler(addspeciallocation_handler)
-
-		removespeciallocation_handler = CommandHandler("removespeciallocation", self.removespeciallocation, pass_args=True)
-		self.dispatcher.add_handler(removespeciallocation_handler)
+	# command, handler, whether it takes arguments
+	COMMANDS = [
+		# test
+		("help", "_help", False),
 
-		showspeciallocation_handler = CommandHandler("showspeciallocation", self.showspeciallocation)
-		self.dispatcher.add_handler(showspeciallocation_handler)
+		# Location Relevance #
+		("addlocation", "addlocation", True),
+		("removelocation", "removelocation", True),
+		("showlocation", "showlocation", False),
+		("setlocation", "setlocation", True),
+		("addspeciallocation", "addspeciallocation", True),
+		("removespeciallocation", "removespeciallocation", True),
+		("showspeciallocation", "showspeciallocation", False),
 
 		# Filter #
-		addfilter_handler = CommandHandler("addfilter", self.addfilter, pass_args=True)
-		self.dispatcher.add_handler(addfilter_handler)
+		("addfilter", "addfilter", True),
+		("removefilter", "removefilter", True),
+		("showfilter", "showfilter", False),
+		("filteron", "filterswitchf", True),
 
-		removefilter_handler = CommandHandler("removefilter", self.removefilter, pass_args=True)
-		self.dispatcher.add_handler(removefilter_handler)
+		# Favourite #
+		("addfav", "addfav", True),
+		("removefav", "removefav", True),
+		("showfav", "showfav", False),
 
-		showfilter_handler = CommandHandler("showfilter", self.showfilter)
-		self.dispatcher.add_handler(showfilter_handler)
+		# Admin #
+		("stats", "stats", False),
+	]
 
-		filterswitch_handler = CommandHandler("filteron", self.filterswitchf, pass_args=True)
-		self.dispatcher.add_handler(filterswitch_handler)
-
-		# Add existing chat ids back into the queue
-		chatids = self.database.get_all_chatid()
-		for chatid in chatids:
-			log.info("Adding #{0} to job queue".format(chatid))
-			job_alarm = Job(self._watch, 240.0 , context=chatid)
-			self.updater.job_queue.put(job_alarm, next_t=0.0)
+	def start(self):
+		for name, handler, pass_args in self.COMMANDS:
+			self.dispatcher.add_handler(CommandHandler(name, getattr(self, handler), pass_args=pass_args))
 
+		self._schedule_jobs()
+		self._start_metrics()
+		self.engine.start()
+		self.outbox.start()
 		self.updater.start_polling()
 		self.updater.idle()
+		self._shutdown()
+
+	def serve(self, commands, peers=()):
+		""" Run as one worker of a sharded setup: take (command, chatid, args)
+			from the coordinator on `commands` until it sends None. `peers` are
+			the other workers' queues, told to reload the special locations
+			after this one changed them"""
+		handlers = dict((name, (getattr(self, handler), pass_args)) for name, handler, pass_args in self.COMMANDS)
+
+		self._schedule_jobs()
+		self._start_metrics()
+		self.updater.job_queue.start()
+		self.engine.start()
+		self.outbox.start()
+
+		while True:
+			command = commands.get()
+			if command is None:
+				break
+
+			name, chatid, args = command
+			if name == RELOAD_SPECIAL:
+				self.database.reload_special_index()
+				continue
+
+			handler, pass_args = handlers[name]
+			update = Update(Message(chatid))
+			try:
+				if pass_args:
+					handler(self.updater.bot, update, args or [])
+				else:
+					handler(self.updater.bot, update)
+			except Exception:
+				log.exception("Error handling /{0} for {1}".format(name, chatid))
+
+			if name in ("addspeciallocation", "removespeciallocation"):
+				for peer in peers:
+					peer.put((RELOAD_SPECIAL, None, None))
+
+		self.updater.job_queue.stop()
+		self._shutdown()
+
+	def _schedule_jobs(self):
+		# One job submits the tiles that are due and the drain job fans results out to their chats
+		log.info("Adding tile scanner to job queue")
+		job_scan = Job(self._scan_tiles, self.scan_tick)
+		self.updater.job_queue.put(job_scan, next_t=0.0)
+
+		job_drain = Job(self._drain_results, _DEFAULT_DRAIN_INTERVAL)
+		self.updater.job_queue.put(job_drain, next_t=0.0)
+
+		# the shards share one database, the first of them keeps it pruned
+		if self.shard == None or self.shard[0] == 0:
+			job_prune = Job(self._prune_history, self.prune_interval)
+			self.updater.job_queue.put(job_prune, next_t=self.prune_interval)
+
+	def _start_metrics(self):
+		if self.metrics_port == None:
+			return
+		try:
+			self.metrics_server = MetricsServer(REGISTRY, self.metrics_host, self.metrics_port)
+			self.metrics_server.start()
+		except Exception as e:
+			log.error("Unable to serve metrics on port {0}: {1}".format(self.metrics_port, e))
+
+	def _shutdown(self):
+		if self.metrics_server != None:
+			self.metrics_server.close()
+		self.engine.stop()
+		self.outbox.close()
+		self.upstream.close()
+		self.reverse_cache.close()
+		self.forward_cache.close()
 
 
 	################## Helper ###################
 	def _update_chatid(self, chatid, lat, lng):
 		#add to  database
 		success = False
-		if chatid not in self.chatids:
+		if int(chatid) not in self.subscribers:
 			success = self.database.add_chatid(chatid, lat, lng)
+			self.subscribers[int(chatid)] = Subscriber(chatid, lat, lng)
+			self.matcher.set_filters(chatid, 0, 0)
 		else:
 			success = self.database.update_current_location(chatid, lat, lng)
+			self.subscribers[int(chatid)].move(lat, lng)
 
 		#update current list
-		self.chatids[int(chatid)] = (lat, lng)
+		self.scheduler.subscribe(chatid, lat, lng)
 
 		return success
 
-	def _add_filter(self, chatid, names):
-		if chatid not in self.chatids:
+	def _add_filter(self, chatid, bits):
+		subscriber = self.subscribers.get(int(chatid))
+		if subscriber == None:
 			log.warning("Chat ID {0} not in database".format(chatid))
 			return False
 
-		if chatid not in self.filters:
-			log.warning("Chat ID {0} not in filters".format(chatid))
+		subscriber.filters |= bits
+		self.database.update_filters(chatid, subscriber.filters)
+		self.matcher.add(chatid, bits)
+
+		return True
+
+	def _remove_filter(self, chatid, bits):
+		subscriber = self.subscribers.get(int(chatid))
+		if subscriber == None:
+			log.warning("Chat ID {0} not in database".format(chatid))
 			return False
 
-		for name in names:
-			self.database.add_filter(chatid, name)
-			self.filters[int(chatid)].append(name)
+		subscriber.filters &= ~bits
+		self.database.update_filters(chatid, subscriber.filters)
+		self.matcher.remove(chatid, bits)
 
 		return True
 
-	def _remove_filter(self, chatid, names):
-		if chatid not in self.chatids:
+	def _add_fav(self, chatid, bits):
+		subscriber = self.subscribers.get(int(chatid))
+		if subscriber == None:
 			log.warning("Chat ID {0} not in database".format(chatid))
 			return False
 
-		if chatid not in self.filters:
-			log.warning("Chat ID {0} not in filters".format(chatid))
+		for name in SPECIES.names_of(bits & ~subscriber.favs):
+			self.database.add_fav(chatid, name)
+		subscriber.favs |= bits
+
+		return True
+
+	def _remove_fav(self, chatid, bits):
+		subscriber = self.subscribers.get(int(chatid))
+		if subscriber == None:
+			log.warning("Chat ID {0} not in database".format(chatid))
 			return False
-		log.info(self.filters[int(chatid)])
-		for name in names:
-			self.database.remove_filter(chatid, name)
-			self.filters[int(chatid)].remove(name)
+
+		# rows written before the registry may be spelt differently, match them by species
+		for fav in self.database.get_favs_by_chatid(chatid):
+			if SPECIES.bit(fav.name) & bits:
+				self.database.remove_fav(chatid, fav.name)
+		subscriber.favs &= ~bits
 
 		return True
 
+	def _unknown_species(self, names):
+		# typos are turned away here, only registry species can be stored as bits
+		if not names:
+			return ""
+		message = "No such pokemon:\n"
+		for name in names:
+			suggestion = SPECIES.suggest(name)
+			if suggestion == None:
+				message += "- {0}\n".format(name)
+			else:
+				message += "- {0}, did you mean {1}?\n".format(name, suggestion)
+		return message
+
 	def _add_location(self, chatid, name, lat, lng):
 		if name == None or lat == None or lng == None:
-			log.warning("name:{0} or lat:{1} or lng:{2} is None".format(name, lta, lng))
+			log.warning("name:{0} or lat:{1} or lng:{2} is None".format(name, lat, lng))
 			return False
 
-		if chatid not in self.chatids:
+		subscriber = self.subscribers.get(int(chatid))
+		if subscriber == None:
 			log.warning("Chat ID {0} not in database".format(chatid))
 			return False
 
-		if chatid not in self.locations:
-			log.warning("Chat ID {0} not in locations".format(chatid))
-			return False
-
 		self.database.add_location(chatid, name, float(lat), float(lng))
-		self.locations[int(chatid)].append((name, float(lat), float(lng)))
+		subscriber.locations += ((name, float(lat), float(lng)),)
 		return True
 
 	def _remove_location(self, chatid, name):
@@ -520,55 +707,81 @@ class Radar():
 			log.warning("name is None")
 			return False
 
-		if chatid not in self.chatids:
+		subscriber = self.subscribers.get(int(chatid))
+		if subscriber == None:
 			log.warning("chatid not found")
 			return False
 
 		self.database.remove_location(chatid, name)
-		for location in self.locations[int(chatid)]:
-			if location[0] == name:
-				self.locations[int(chatid)].remove(location)
-				break
+		subscriber.locations = tuple(l for l in subscriber.locations if l[0] != name)
 
 		return True
 
 	def _get_location(self, location):
+		with STAGES["get_location"].time():
+			return self._lookup_location(location)
+
+	def _lookup_location(self, location):
+		key = self.reverse_cache.key(location)
+		address = self.reverse_cache.get(key)
+		if address != None:
+			return address
+
 		reverse_geocode_result = self.gmaps.reverse_geocode(location)
 
 		if len(reverse_geocode_result) == 0:
-			self.logger.warning("No geocoding for {0}".format(location))
+			log.warning("No geocoding for {0}".format(location))
 			return None
 		elif "formatted_address" not in reverse_geocode_result[0]:
-			self.logger.warning("Could not find any formatted address for {0}".formatted(location))
+			log.warning("Could not find any formatted address for {0}".format(location))
 			return None
 		else:
-			return reverse_geocode_result[0]["formatted_address"]
+			address = reverse_geocode_result[0]["formatted_address"]
+			self.reverse_cache.put(key, address)
+			return address
 
 	def _get_special_location(self, location):
-		log.info("Getting special location for {0}".format(location))
+		log.debug("Getting special location for {0}".format(location))
 
 		# Given location of the Pokemon
 		pokemon_lat = float(location[0])
 		pokemon_lng = float(location[1])
 
-		min_lat = pokemon_lat - self.radius
-		max_lat = pokemon_lat + self.radius
-
-		min_lng = pokemon_lng - self.radius
-		max_lng = pokemon_lng + self.radius
-
-		return self.database.check_speciallocation(min_lat, max_lat,  min_lng, max_lng)
+		with STAGES["get_special_location"].time():
+			return self.database.find_speciallocation(pokemon_lat, pokemon_lng)
+
+	def _register_gauges(self):
+		gauge = REGISTRY.gauge
+		gauge("kopiradar_chats", "Chats served by this process", lambda: len(self.subscribers))
+		gauge("kopiradar_tiles", "Occupied tiles", lambda: len(self.scheduler.tiles))
+		gauge("kopiradar_tiles_hastened", "Tiles on the favourites scan cadence", self.scheduler.hastened)
+		gauge("kopiradar_queue_depth", "Items waiting in each queue", self.engine.results.qsize, queue="scan_results")
+		gauge("kopiradar_queue_depth", "Items waiting in each queue", self.engine.pending, queue="scans_pending")
+		gauge("kopiradar_queue_depth", "Items waiting in each queue", self.engine.backing_off, queue="scans_backing_off")
+		gauge("kopiradar_queue_depth", "Items waiting in each queue", lambda: len(self.outbox), queue="outbox")
+		gauge("kopiradar_queue_depth", "Items waiting in each queue", lambda: len(self.database.writes), queue="db_writes")
+		for name, cache in (("reverse_geocode", self.reverse_cache), ("forward_geocode", self.forward_cache)):
+			gauge("kopiradar_cache_hit_rate", "Hit rate of each cache", lambda cache=cache: cache.stats()["hit_rate"], cache=name)
+		if self.upstream is not self.fetcher:
+			gauge("kopiradar_cache_hit_rate", "Hit rate of each cache", lambda: self.upstream.cache.stats()["hit_rate"], cache="tiles")
 
 	def _get_location_by_name(self, location):
 		log.info("Getting location for {0}".format(location))
+		key = self.forward_cache.key(location)
+		geocode_result = self.forward_cache.get(key)
+		if geocode_result != None:
+			return geocode_result
+
 		geocode_result = self.gmaps.geocode(location)
 
 		if len(geocode_result) == 0:
 			log.warning("No geocoding for {0}".format(location))
 			return None
 		elif "formatted_address" not in geocode_result[0]:
-			log.warning("Could not find any formatted address for {0}".formatted(location))
+			log.warning("Could not find any formatted address for {0}".format(location))
 			return None
 		else:
 			log.debug(geocode_result)
+			geocode_result = self.forward_cache.compact(geocode_result)
+			self.forward_cache.put(key, geocode_result)
 			return geocode_result
@@ -0,0 +1,49 @@
+import logging
+
+log = logging.getLogger(__name__)
+
+_MAP_URL = "https://www.google.com/maps/place/{0},{1}"
+
+class AlertRenderer(object):
+    """ Format each sighting once and build every chat's alert from the
+        pre-rendered pieces.
+
+        `locate(location)` gives the address of a (lat, lng) and `special(location)`
+        the special location it falls in, or False. Fragments are kept until
+        `reset()`, which Radar calls once per drain tick, so a sighting that goes
+        out to many chats is looked up and formatted only once"""
+
+    def __init__(self, locate, special):
+        self.locate     = locate
+        self.special    = special
+        self._fragments = {}    # sighting -> (summary, body)
+
+    def reset(self):
+        self._fragments = {}
+
+    def fragment(self, sighting):
+        fragment = self._fragments.get(sighting)
+        if fragment is None:
+            fragment = self._fragments[sighting] = self._render(sighting)
+        return fragment
+
+    def message(self, sightings):
+        """ The alert for sightings, None when there is nothing to say"""
+        if not sightings:
+            return None
+        fragments = [self.fragment(sighting) for sighting in sightings]
+        return "".join([summary for summary, body in fragments] + ["\n\n"] + [body for summary, body in fragments])
+
+    def _render(self, sighting):
+        location = (sighting.lat, sighting.lng)
+        lat, lng = str(sighting.lat), str(sighting.lng)
+
+        special = self.special(location)
+        if special != False:
+            tag = special.upper()
+        else:
+            tag = "({0},{1})".format(lat, lng)
+
+        body = "{0}: {1}\n{2}\n{3}\n{4}\n\n".format(
+            sighting.pokemon, sighting.expire, self.locate(location), _MAP_URL.format(lat, lng), tag)
+        return (sighting.pokemon.upper() + " ", body)
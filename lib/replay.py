@@ -0,0 +1,165 @@
+import gzip
+import json
+import time
+import zlib
+import bisect
+import struct
+import logging
+import threading
+
+from lib.constants import _DEFAULT_RECORD_FLUSH, _DEFAULT_REPLAY_SPEED
+
+log = logging.getLogger(__name__)
+
+_EMPTY_RESULT = '{"result": []}'
+
+def _key(coordinates):
+    return "{0},{1}".format(coordinates[0], coordinates[1])
+
+class Recorder(object):
+    """ Fetcher front that appends every upstream response, with its
+        coordinates and the time it came back, to a gzip file of JSON lines.
+
+        Each run appends a new gzip member, which gzip readers see as one
+        stream. The file is synced every `flush_every` records, so a crash
+        loses at most that many"""
+
+    def __init__(self, fetcher, path, flush_every=_DEFAULT_RECORD_FLUSH):
+        self.fetcher        = fetcher
+        self.path           = path
+        self.flush_every    = int(flush_every)
+        self.recorded       = 0
+
+        self._file = gzip.open(path, "ab")
+        self._lock = threading.Lock()
+        log.info("Recording upstream responses to {0}".format(path))
+
+    def fetch(self, coordinates):
+        body = self.fetcher.fetch(coordinates)
+        self.record(coordinates, body)
+        return body
+
+    def record(self, coordinates, body, at=None):
+        # a failed fetch is kept too, the overload pattern is part of the traffic
+        line = json.dumps({"t": at or time.time(), "lat": coordinates[0], "lng": coordinates[1], "body": body}) + "\n"
+        with self._lock:
+            self._file.write(line)
+            self.recorded += 1
+            if self.recorded % self.flush_every == 0:
+                self._file.flush(zlib.Z_SYNC_FLUSH)
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+        self.fetcher.close()
+
+def read_records(path):
+    """ Yield the recorded {"t", "lat", "lng", "body"} dicts in file order. A
+        torn tail, left by a crash mid-write, ends the iteration with a warning"""
+    f = gzip.open(path, "rb")
+    try:
+        for line in f:
+            try:
+                yield json.loads(line)
+            except ValueError:
+                log.warning("Skipping the torn end of {0}".format(path))
+                return
+    except (IOError, EOFError, zlib.error, struct.error, TypeError) as e:
+        # gzip raises struct.error or TypeError when the cut falls in a member header
+        log.warning("Recording {0} ends early: {1}".format(path, e))
+    finally:
+        f.close()
+
+def shift_expiry(body, recorded_now, now, speed):
+    """ body with every expiration_timestamp_ms moved so that it lies as far
+        ahead of `now` as it lay ahead of `recorded_now`, divided by speed"""
+    if speed <= 0:
+        raise ValueError("Replay speed must be above 0, got {0}".format(speed))
+    try:
+        data = json.loads(body)
+    except ValueError:
+        return body
+    if not isinstance(data, dict) or not isinstance(data.get("result"), list):
+        return body
+
+    for r in data["result"]:
+        if isinstance(r, dict) and "expiration_timestamp_ms" in r:
+            expires_at = int(r["expiration_timestamp_ms"]) / 1000.0
+            r["expiration_timestamp_ms"] = str(int((now + (expires_at - recorded_now) / speed) * 1000))
+    return json.dumps(data)
+
+class ReplayFetcher(object):
+    """ Stands in for Fetcher and answers from a recording.
+
+        The recording plays on a virtual clock that starts at its first record
+        when the first fetch is made and runs `speed` times faster than the
+        wall clock. A fetch returns the latest response recorded for those
+        coordinates at the current virtual time. Expiry times are shifted
+        to match, so dedup and scheduling see live-looking sightings.
+        Coordinates that were never recorded get an empty result.
+
+        Unlike replay(), a speed of 0 is refused: the virtual clock needs a
+        finite rate, and the scan scheduler cannot go as fast as possible"""
+
+    def __init__(self, path, speed=_DEFAULT_REPLAY_SPEED, shift=True, clock=time.time):
+        if float(speed) <= 0:
+            raise ValueError("[upstream] replay_speed must be above 0 to replay through the scanner, got {0}".format(speed))
+        self.path       = path
+        self.speed      = float(speed)
+        self.shift      = shift
+        self.clock      = clock
+
+        self._times     = {}    # key -> sorted record times
+        self._bodies    = {}    # key -> bodies in the same order
+        self._origin    = None
+        self._started   = None
+
+        records = sorted(read_records(path), key=lambda r: r["t"])
+        for r in records:
+            key = _key((r["lat"], r["lng"]))
+            self._times.setdefault(key, []).append(r["t"])
+            self._bodies.setdefault(key, []).append(r["body"])
+        if records:
+            self._origin = records[0]["t"]
+        log.info("Replaying {0} responses for {1} coordinates from {2} at {3}x".format(len(records), len(self._times), path, self.speed))
+
+    def virtual_now(self):
+        now = self.clock()
+        if self._started is None:
+            self._started = now
+        return self._origin + (now - self._started) * self.speed
+
+    def fetch(self, coordinates):
+        key = _key(coordinates)
+        times = self._times.get(key)
+        if not times:
+            return _EMPTY_RESULT
+
+        recorded_now = self.virtual_now()
+        # before the first response for these coordinates, replay that first one
+        i = max(0, bisect.bisect_right(times, recorded_now) - 1)
+        body = self._bodies[key][i]
+        if body is None or not self.shift:
+            return body
+        return shift_expiry(body, recorded_now, self.clock(), self.speed)
+
+    def close(self):
+        pass
+
+def replay(path, sink, speed=_DEFAULT_REPLAY_SPEED, clock=time.time, sleep=time.sleep):
+    """ Call sink(coordinates, body, recorded_at) for every record, spaced out as
+        they were recorded divided by speed. A speed of 0 replays as fast as
+        sink keeps up. Returns the number of records replayed"""
+    speed = float(speed)
+    origin = started = None
+    count = 0
+    for r in read_records(path):
+        if origin is None:
+            origin, started = r["t"], clock()
+        if speed > 0:
+            delay = started + (r["t"] - origin) / speed - clock()
+            if delay > 0:
+                sleep(delay)
+        sink((r["lat"], r["lng"]), r["body"], r["t"])
+        count += 1
+    return count
@@ -0,0 +1,238 @@
+import math
+import time
+import zlib
+import logging
+import threading
+from collections import deque
+
+from lib.constants import _DEFAULT_TILE_SIZE, _DEFAULT_SCAN_INTERVAL, _DEFAULT_MIN_INTERVAL, _DEFAULT_MAX_INTERVAL
+from lib.constants import _DEFAULT_IDLE_CYCLES, _DEFAULT_IDLE_BACKOFF, _DEFAULT_SCAN_JITTER
+from lib.constants import _DEFAULT_EXPIRY_SETTLE, _DEFAULT_SPAWN_BUCKET, _DEFAULT_SPAWN_PHASES
+from lib.constants import _DEFAULT_FAV_INTERVAL, _DEFAULT_FAV_WINDOW
+
+_HOUR = 3600
+
+log = logging.getLogger(__name__)
+
+class TileScheduler(object):
+    """ Group chats by the grid tile of their current location so that every
+        tile is fetched once per cycle, however many chats are subscribed to it.
+
+        Each tile keeps its own scan interval. It starts at `interval`, drops
+        back to `min_interval` whenever a scan turns up something new, and grows
+        by `backoff` (up to `max_interval`) after `idle_cycles` quiet scans in a
+        row. Scans fall on a grid of slots one interval apart, each moved by
+        +/- `jitter`. The grid's offset and every slot's jitter are drawn from
+        the tile alone, so tiles do not line up with each other but every
+        process that scans the same tile picks the same moment.
+
+        Within those bounds a scan is brought forward to `settle` seconds after
+        the earliest known expiry among the tile's sightings, and after the next
+        point in the hour at which new pokemon have turned up there before,
+        since spawn points repeat hourly. `spawn_bucket` is the resolution of
+        those points and `spawn_phases` how many a tile remembers. Neither ever
+        brings two scans of a tile closer than `min_interval`.
+
+        A tile where one of its chats' favourites turned up is hastened: for
+        `fav_window` seconds it is scanned every `fav_interval`, which then
+        takes the place of `min_interval`"""
+
+    def __init__(self, tile_size=_DEFAULT_TILE_SIZE, interval=_DEFAULT_SCAN_INTERVAL, min_interval=_DEFAULT_MIN_INTERVAL,
+                 max_interval=_DEFAULT_MAX_INTERVAL, idle_cycles=_DEFAULT_IDLE_CYCLES, backoff=_DEFAULT_IDLE_BACKOFF,
+                 jitter=_DEFAULT_SCAN_JITTER, settle=_DEFAULT_EXPIRY_SETTLE, spawn_bucket=_DEFAULT_SPAWN_BUCKET,
+                 spawn_phases=_DEFAULT_SPAWN_PHASES, fav_interval=_DEFAULT_FAV_INTERVAL, fav_window=_DEFAULT_FAV_WINDOW):
+        self.tile_size      = float(tile_size)
+        self.interval       = float(interval)
+        self.min_interval   = float(min_interval)
+        self.max_interval   = float(max_interval)
+        self.idle_cycles    = int(idle_cycles)
+        self.backoff        = float(backoff)
+        self.jitter         = float(jitter)
+        self.settle         = float(settle)
+        self.spawn_bucket   = int(spawn_bucket)
+        self.spawn_phases   = int(spawn_phases)
+        self.fav_interval   = float(fav_interval)
+        self.fav_window     = float(fav_window)
+
+        self.tiles      = {}    # tile -> set of chatids
+        self.chat_tiles = {}    # chatid -> tile
+
+        self._next      = {}    # tile -> epoch of the next scan
+        self._intervals = {}    # tile -> current scan interval
+        self._idle      = {}    # tile -> scans in a row with nothing new
+        self._last      = {}    # tile -> sighting keys of the last scan
+        self._phases    = {}    # tile -> buckets of the hour new pokemon appeared in
+        self._hastened  = {}    # tile -> epoch until which it is scanned every fav_interval
+        self._lock      = threading.RLock()
+
+    def tile_of(self, lat, lng):
+        return (int(math.floor(float(lat) / self.tile_size)), int(math.floor(float(lng) / self.tile_size)))
+
+    def center_of(self, tile):
+        return ((tile[0] + 0.5) * self.tile_size, (tile[1] + 0.5) * self.tile_size)
+
+    def subscribe(self, chatid, lat, lng):
+        chatid = int(chatid)
+        tile = self.tile_of(lat, lng)
+
+        with self._lock:
+            old_tile = self.chat_tiles.get(chatid)
+            if old_tile == tile:
+                return tile
+            if old_tile is not None:
+                self._discard(chatid, old_tile)
+
+            self.chat_tiles[chatid] = tile
+            if tile not in self.tiles:
+                self.tiles[tile] = set()
+                self._intervals[tile] = self.interval
+                self._idle[tile] = 0
+                self._next[tile] = self._slot(tile, time.time(), self.interval)
+            self.tiles[tile].add(chatid)
+
+        log.debug("Chat ID {0} subscribed to tile {1}".format(chatid, tile))
+        return tile
+
+    def unsubscribe(self, chatid):
+        chatid = int(chatid)
+        with self._lock:
+            tile = self.chat_tiles.pop(chatid, None)
+            if tile is not None:
+                self._discard(chatid, tile)
+
+    def subscribers(self, tile):
+        # a copy, the dispatcher thread moves chats while results are drained
+        with self._lock:
+            return set(self.tiles.get(tile, ()))
+
+    def occupied_tiles(self):
+        # copy so that subscriptions can change while a cycle is running
+        with self._lock:
+            return [(tile, list(chats)) for tile, chats in self.tiles.items() if chats]
+
+    def spread(self, now=None):
+        """ Put every tile's first scan in its first slot after now. Slot offsets
+            are spread over the interval, so a restart does not scan everything
+            at once, and shards restarting apart still agree on them"""
+        now = now or time.time()
+        with self._lock:
+            for tile in self.tiles:
+                self._next[tile] = self._slot(tile, now - self.interval / 2.0, self.interval)
+
+    def due(self, now=None):
+        """ Tiles whose scan time has come. They are pushed one interval ahead
+            so they are not handed out again while the scan is in flight"""
+        now = now or time.time()
+        tiles = []
+        with self._lock:
+            for tile, next_scan in self._next.iteritems():
+                if next_scan <= now:
+                    tiles.append(tile)
+            for tile in tiles:
+                self._next[tile] = now + self._intervals[tile]
+        return tiles
+
+    def observe(self, tile, sightings, now=None):
+        """ Adapt the tile's interval to whether this scan found anything new, and
+            bring its next scan forward to the next expected despawn or spawn"""
+        now = now or time.time()
+        keys = frozenset((s.name, s.lat, s.lng, s.expires_at) for s in sightings)
+
+        with self._lock:
+            if tile not in self.tiles:
+                return
+            last = self._last.get(tile)
+            if keys - (last or frozenset()):
+                self._idle[tile] = 0
+                self._intervals[tile] = self.min_interval
+                # the first scan of a tile says nothing about when things appeared
+                if last is not None:
+                    self._learn_phase(tile, now)
+            else:
+                self._idle[tile] += 1
+                if self._idle[tile] >= self.idle_cycles:
+                    self._intervals[tile] = min(self.max_interval, self._intervals[tile] * self.backoff)
+            self._last[tile] = keys
+
+            interval = self._intervals[tile]
+            shortest = self.min_interval
+            if self._hastened.get(tile, 0) > now:
+                interval = min(interval, self.fav_interval)
+                shortest = min(shortest, self.fav_interval)
+            else:
+                self._hastened.pop(tile, None)
+            next_scan = self._slot(tile, now, interval, shortest)
+            # despawns and spawns only ever bring the scan forward, never below the shortest interval
+            for event in (self._next_expiry(sightings, now), self._next_spawn(tile, now)):
+                if event is not None:
+                    next_scan = min(next_scan, max(now + shortest, event + self.settle))
+            self._next[tile] = next_scan
+
+    def hasten(self, tile, now=None):
+        """ Scan the tile every fav_interval for the next fav_window seconds,
+            starting with its next fav_interval slot"""
+        now = now or time.time()
+        with self._lock:
+            if tile not in self.tiles:
+                return
+            self._hastened[tile] = now + self.fav_window
+            self._next[tile] = min(self._next[tile], self._slot(tile, now, self.fav_interval, self.fav_interval))
+
+    def hastened(self, now=None):
+        now = now or time.time()
+        with self._lock:
+            return sum(1 for until in self._hastened.itervalues() if until > now)
+
+    def interval_of(self, tile):
+        return self._intervals.get(tile)
+
+    def next_scan(self, tile):
+        return self._next.get(tile)
+
+    def _learn_phase(self, tile, now):
+        phase = int(now) % _HOUR // self.spawn_bucket
+        phases = self._phases.get(tile)
+        if phases is None:
+            phases = self._phases[tile] = deque(maxlen=self.spawn_phases)
+        if phase not in phases:
+            phases.append(phase)
+
+    def _next_expiry(self, sightings, now):
+        expiries = [s.expires_at for s in sightings if s.expires_at and s.expires_at > now]
+        return min(expiries) if expiries else None
+
+    def _next_spawn(self, tile, now):
+        """ Epoch of the start of the next learnt spawn bucket, None when nothing was learnt yet"""
+        phases = self._phases.get(tile)
+        if not phases:
+            return None
+        hour = int(now) - int(now) % _HOUR
+        offset = int(now) % _HOUR
+        starts = [phase * self.spawn_bucket for phase in phases]
+        upcoming = [start for start in starts if start > offset]
+        return hour + min(upcoming) if upcoming else hour + _HOUR + min(starts)
+
+    def _draw(self, tile, *salt):
+        """ A number in [0, 1) that depends only on the tile and salt, the same in every process"""
+        return (zlib.crc32(repr((tile,) + salt)) & 0xffffffff) / 4294967296.0
+
+    def _slot(self, tile, now, interval, shortest=0.0):
+        """ The tile's first scan slot at least half an interval, and at least
+            `shortest`, after now, so scans are on average one interval apart"""
+        earliest = now + max(interval / 2.0, shortest)
+        offset = self._draw(tile) * interval
+        first = int(math.ceil((earliest - offset) / interval))
+        for k in (first, first + 1):
+            slot = offset + k * interval + (2 * self._draw(tile, k) - 1) * self.jitter * interval
+            if slot >= earliest:
+                return slot
+
+    def _discard(self, chatid, tile):
+        chats = self.tiles.get(tile)
+        if chats is None:
+            return
+        chats.discard(chatid)
+        if not chats:
+            del self.tiles[tile]
+            for state in (self._next, self._intervals, self._idle, self._last, self._phases, self._hastened):
+                state.pop(tile, None)
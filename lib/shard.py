@@ -0,0 +1,44 @@
+import logging
+from collections import namedtuple
+
+from telegram.ext import Updater
+from telegram.ext import CommandHandler
+
+log = logging.getLogger(__name__)
+
+# just enough of a telegram Update for Radar's command handlers
+Message = namedtuple("Message", "chat_id")
+Update  = namedtuple("Update", "message")
+
+# sent to every other worker after a shard changed the special locations
+RELOAD_SPECIAL = "_reload_special"
+
+def shard_of(chatid, shards):
+    return int(chatid) % int(shards)
+
+class Coordinator(object):
+    """ Owns the Telegram polling when Radar runs as several worker processes.
+
+        Every command is forwarded as (command, chatid, args) to the queue of
+        the worker that owns the chat. Workers do the work and reply through
+        their own bot, so the coordinator never touches the database"""
+
+    def __init__(self, token, commands, queues):
+        self.updater    = Updater(token=token)
+        self.queues     = queues
+
+        for name, pass_args in commands:
+            self.updater.dispatcher.add_handler(CommandHandler(name, self._forward(name), pass_args=pass_args))
+
+    def _forward(self, name):
+        def forward(bot, update, args=None):
+            chatid = update.message.chat_id
+            self.queues[shard_of(chatid, len(self.queues))].put((name, chatid, args))
+        return forward
+
+    def start(self):
+        log.info("Coordinating {0} workers".format(len(self.queues)))
+        self.updater.start_polling()
+        self.updater.idle()
+        for queue in self.queues:
+            queue.put(None)
@@ -0,0 +1,38 @@
+import time
+from collections import namedtuple
+
+from lib.constants import _EXPIRE_FORMAT, _UNKNOWN_EXPIRE
+
+# name is the lower-cased pokemon used for filter matching; expires_at is the
+# epoch it disappears at (None when upstream did not say) and expire its display form
+Sighting = namedtuple("Sighting", "pokemon name lat lng expires_at expire")
+
+def parse_sighting(r):
+    """ Sighting for one upstream result record, or None when it has no pokemon or position"""
+    pokemon = None
+
+    # get the name of the pokemon
+    if "pokemon_id" in r:
+        pokemon = r["pokemon_id"]
+    elif "lure_info" in r:
+        if "active_pokemon_id" in r["lure_info"]:
+            pokemon = r["lure_info"]["active_pokemon_id"]
+
+    if pokemon == None or "latitude" not in r:
+        return None
+
+    if "expiration_timestamp_ms" in r:
+        expires_at = int(r["expiration_timestamp_ms"])/1000
+        expire = time.strftime(_EXPIRE_FORMAT, time.localtime(expires_at))
+    else:
+        expires_at = None
+        expire = _UNKNOWN_EXPIRE
+
+    return Sighting(pokemon, pokemon.lower(), float(r["latitude"]), float(r["longitude"]), expires_at, expire)
+
+def parse_sightings(records):
+    """ Yield a Sighting for every usable record of an iterable of upstream records"""
+    for r in records:
+        sighting = parse_sighting(r)
+        if sighting != None:
+            yield sighting
@@ -0,0 +1,62 @@
+import math
+import logging
+import threading
+
+from lib.constants import _DEFAULT_SPATIAL_CELL
+
+log = logging.getLogger(__name__)
+
+class GridIndex(object):
+    """ Uniform grid over lat/lng boxes. Every box is registered in each cell
+        it overlaps, so a point lookup only checks the boxes of one cell"""
+
+    def __init__(self, cell_size=_DEFAULT_SPATIAL_CELL):
+        self.cell_size  = float(cell_size)
+        self._cells     = {}    # cell -> set of keys
+        self._boxes     = {}    # key -> (name, minlat, maxlat, minlng, maxlng)
+        self._lock      = threading.Lock()
+
+    def __len__(self):
+        return len(self._boxes)
+
+    def _cell(self, lat, lng):
+        return (int(math.floor(lat / self.cell_size)), int(math.floor(lng / self.cell_size)))
+
+    def _cells_of(self, minlat, maxlat, minlng, maxlng):
+        lo = self._cell(minlat, minlng)
+        hi = self._cell(maxlat, maxlng)
+        for x in range(lo[0], hi[0] + 1):
+            for y in range(lo[1], hi[1] + 1):
+                yield (x, y)
+
+    def insert(self, key, name, minlat, maxlat, minlng, maxlng):
+        box = (name, float(minlat), float(maxlat), float(minlng), float(maxlng))
+        with self._lock:
+            self._remove(key)
+            self._boxes[key] = box
+            for cell in self._cells_of(*box[1:]):
+                self._cells.setdefault(cell, set()).add(key)
+
+    def remove(self, key):
+        with self._lock:
+            self._remove(key)
+
+    def query(self, lat, lng):
+        """ Names of the boxes containing (lat, lng), in key order"""
+        lat = float(lat)
+        lng = float(lng)
+        with self._lock:
+            keys = self._cells.get(self._cell(lat, lng), ())
+            return [self._boxes[k][0] for k in sorted(keys)
+                    if self._boxes[k][1] <= lat <= self._boxes[k][2] and self._boxes[k][3] <= lng <= self._boxes[k][4]]
+
+    def _remove(self, key):
+        box = self._boxes.pop(key, None)
+        if box is None:
+            return
+        for cell in self._cells_of(*box[1:]):
+            keys = self._cells.get(cell)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._cells[cell]
@@ -0,0 +1,92 @@
+import re
+import logging
+import binascii
+import difflib
+
+from lib.constants import _SPECIES_FILE
+
+log = logging.getLogger(__name__)
+
+_NOT_ALNUM = re.compile(r"[^0-9a-z]")
+
+def species_key(name):
+    """ Spelling-insensitive key of a species name, so "Mr. Mime", "mr_mime"
+        and upstream's "MR_MIME" all come out as "mrmime" """
+    return intern(str(_NOT_ALNUM.sub("", name.lower())))
+
+class SpeciesRegistry(object):
+    """ A fixed id for every species in utils/pokemons.txt, so that a set of
+        species is a single integer with one bit per id.
+
+        An id is the species' position in the file, so the file must only ever
+        be appended to or bitsets that were already stored change meaning"""
+
+    def __init__(self, names):
+        self.names  = tuple(intern(str(name)) for name in names)  # id -> display name
+        self.width  = len(self.names)
+        self.size   = (self.width + 7) // 8  # bytes in a stored bitset
+        self.mask   = (1 << self.width) - 1
+
+        self._ids   = {}    # key -> id
+        self._bits  = {}    # name as upstream or the user spelt it -> bit, 0 if unknown
+        for i, name in enumerate(self.names):
+            self._ids.setdefault(species_key(name), i)
+
+    @classmethod
+    def load(cls, path=_SPECIES_FILE):
+        with open(path) as f:
+            names = [line.strip() for line in f if line.strip()]
+        log.info("Loaded {0} species from {1}".format(len(names), path))
+        return cls(names)
+
+    def __len__(self):
+        return self.width
+
+    def id_of(self, name):
+        """ The species' id, or None when there is no such species"""
+        return self._ids.get(species_key(name))
+
+    def name_of(self, name):
+        """ The species' display name, or None when there is no such species"""
+        i = self.id_of(name)
+        return None if i is None else self.names[i]
+
+    def bit(self, name):
+        # sightings repeat the same few names, so the key is worked out once per spelling
+        bit = self._bits.get(name)
+        if bit is None:
+            i = self.id_of(name)
+            bit = self._bits[name] = 0 if i is None else 1 << i
+        return bit
+
+    def lookup(self, names):
+        """ (bitset, unknown) of names, where unknown lists those that are no species"""
+        bits = 0
+        unknown = []
+        for name in names:
+            i = self.id_of(name)
+            if i is None:
+                unknown.append(name)
+            else:
+                bits |= 1 << i
+        return bits, unknown
+
+    def names_of(self, bits):
+        """ Display names of the species in bits, in id order"""
+        return [self.names[i] for i in range(self.width) if bits >> i & 1]
+
+    def suggest(self, name):
+        """ The display name closest to a misspelt name, or None"""
+        close = difflib.get_close_matches(species_key(name), self._ids.keys(), n=1)
+        return self.names[self._ids[close[0]]] if close else None
+
+    def encode(self, bits):
+        """ bits as `size` big-endian bytes, the form stored in chatids.filter_bits"""
+        return binascii.unhexlify("{0:0{1}x}".format(bits & self.mask, self.size * 2))
+
+    def decode(self, data):
+        if not data:
+            return 0
+        return int(binascii.hexlify(data), 16) & self.mask
+
+SPECIES = SpeciesRegistry.load()
@@ -0,0 +1,68 @@
+import re
+import json
+import logging
+
+log = logging.getLogger(__name__)
+
+_WHITESPACE = re.compile(r"\s*")
+_DECODER    = json.JSONDecoder()
+
+def _skip(body, index):
+    return _WHITESPACE.match(body, index).end()
+
+def find_results(body):
+    """ Offset of the "[" that opens the top-level "result" array of an upstream
+        payload, or None when the payload is not an object with such an array
+        (the server says it is overloaded that way).
+
+        Only the keys and the values that come before "result" are decoded, so
+        a large payload is never turned into one big dict"""
+    index = _skip(body, 0)
+    if body[index:index + 1] != "{":
+        return None
+    index = _skip(body, index + 1)
+
+    while body[index:index + 1] == '"':
+        key, index = _DECODER.raw_decode(body, index)
+        index = _skip(body, index)
+        if body[index:index + 1] != ":":
+            return None
+        index = _skip(body, index + 1)
+
+        if key == "result":
+            return index if body[index:index + 1] == "[" else None
+
+        value, index = _DECODER.raw_decode(body, index)
+        index = _skip(body, index)
+        if body[index:index + 1] == ",":
+            index = _skip(body, index + 1)
+
+    return None
+
+def iter_results(body, start):
+    """ Yield the records of the array that opens at `start` one at a time. A
+        payload that turns out to be malformed part way through ends the
+        iteration with a warning rather than losing what came before it"""
+    index = _skip(body, start + 1)
+    try:
+        if body[index:index + 1] == "]":
+            return
+        while True:
+            record, index = _DECODER.raw_decode(body, index)
+            yield record
+
+            index = _skip(body, index)
+            separator = body[index:index + 1]
+            if separator == "]":
+                return
+            if separator != ",":
+                raise ValueError("Expecting , or ] at {0}".format(index))
+            index = _skip(body, index + 1)
+    except ValueError as e:
+        log.warning("Malformed result array: {0}".format(e))
+
+def preview(body, limit):
+    """ body cut down to `limit` characters for logging"""
+    if len(body) <= limit:
+        return body
+    return "{0}... ({1} more bytes)".format(body[:limit], len(body) - limit)
@@ -0,0 +1,29 @@
+class Subscriber(object):
+    """ Everything Radar keeps for one chat, in a single slotted record.
+
+        filters and favs are species bitsets (see lib.species). locations is a
+        tuple that gets replaced on change rather than mutated, so the many
+        chats without any share the one empty tuple"""
+
+    __slots__ = ("chatid", "lat", "lng", "filterswitch", "filters", "locations", "favs")
+
+    def __init__(self, chatid, lat, lng, filterswitch=0, filters=0, locations=(), favs=0):
+        self.chatid         = int(chatid)
+        self.lat            = float(lat)
+        self.lng            = float(lng)
+        self.filterswitch   = filterswitch
+        self.filters        = filters
+        self.locations      = tuple((name, float(lat), float(lng)) for name, lat, lng in locations)
+        self.favs           = favs
+
+    def __repr__(self):
+        return "<Subscriber({0}, {1}, {2}, {3}, {4}, {5}, {6})>".format(
+            self.chatid, self.lat, self.lng, self.filterswitch, self.filters, self.locations, self.favs)
+
+    @property
+    def location(self):
+        return (self.lat, self.lng)
+
+    def move(self, lat, lng):
+        self.lat = float(lat)
+        self.lng = float(lng)
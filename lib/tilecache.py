@@ -0,0 +1,156 @@
+import os
+import time
+import logging
+import sqlite3
+import threading
+
+from lib.constants import _ROOT, _DEFAULT_RESULT_TTL, _DEFAULT_BUSY_TIMEOUT, _DEFAULT_FETCH_LEASE
+from lib.stream import find_results
+
+log = logging.getLogger(__name__)
+
+_TILE_DB = os.path.join(_ROOT, "db", "tiles.db")
+_POLL    = 0.2
+
+class TileCache(object):
+    """ Recent upstream responses in a SQLite file that every worker process
+        opens, so a tile scanned by one shard is not fetched again by another
+        within `ttl` seconds.
+
+        A process about to fetch a tile takes a lease on it first, so shards
+        that scan the tile at the same moment wait for that one fetch instead
+        of making their own"""
+
+    def __init__(self, path=_TILE_DB, ttl=_DEFAULT_RESULT_TTL, busy_timeout=_DEFAULT_BUSY_TIMEOUT):
+        self.ttl        = float(ttl)
+        self.hits       = 0
+        self.misses     = 0
+        self._lock      = threading.Lock()
+
+        db_dir = os.path.dirname(path)
+        if not os.path.exists(db_dir):
+            try:
+                os.makedirs(db_dir)
+            except:
+                log.error("Error in making {0}".format(db_dir))
+
+        self._conn = sqlite3.connect(path, timeout=float(busy_timeout), check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS tiles (key TEXT PRIMARY KEY, body BLOB NOT NULL, fetched REAL NOT NULL)")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS leases (key TEXT PRIMARY KEY, owner TEXT NOT NULL, expires REAL NOT NULL)")
+        self._conn.commit()
+
+    def _fresh(self, key):
+        row = self._conn.execute("SELECT fetched, body FROM tiles WHERE key = ?", (key,)).fetchone()
+        if row is None or time.time() - row[0] > self.ttl:
+            return None
+        return str(row[1])
+
+    def get(self, key):
+        with self._lock:
+            body = self._fresh(key)
+            if body is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+            return body
+
+    def lease(self, key, owner, duration):
+        """ True when owner now holds the lease on key for `duration` seconds,
+            False while another owner's lease is still running"""
+        now = time.time()
+        with self._lock:
+            try:
+                self._conn.execute("DELETE FROM leases WHERE key = ? AND expires < ?", (key, now))
+                taken = self._conn.execute("INSERT OR IGNORE INTO leases (key, owner, expires) VALUES (?, ?, ?)",
+                                           (key, owner, now + float(duration))).rowcount == 1
+                self._conn.commit()
+                return taken
+            except sqlite3.Error as e:
+                # fetching without a lease only costs a duplicate request
+                log.error("Error in leasing tile {0}: {1}".format(key, e))
+                return True
+
+    def release(self, key, owner):
+        with self._lock:
+            try:
+                self._conn.execute("DELETE FROM leases WHERE key = ? AND owner = ?", (key, owner))
+                self._conn.commit()
+            except sqlite3.Error as e:
+                log.error("Error in releasing tile {0}: {1}".format(key, e))
+
+    def wait(self, key, timeout):
+        """ The body another process stores under key within `timeout` seconds.
+            None once its lease is gone without a body, or on timeout"""
+        deadline = time.time() + float(timeout)
+        while time.time() < deadline:
+            time.sleep(_POLL)
+            with self._lock:
+                body = self._fresh(key)
+                if body is not None:
+                    self.hits += 1
+                    return body
+                if self._conn.execute("SELECT 1 FROM leases WHERE key = ? AND expires >= ?", (key, time.time())).fetchone() is None:
+                    break
+        with self._lock:
+            self.misses += 1
+        return None
+
+    def put(self, key, body):
+        now = time.time()
+        with self._lock:
+            try:
+                self._conn.execute("INSERT OR REPLACE INTO tiles (key, body, fetched) VALUES (?, ?, ?)", (key, sqlite3.Binary(body), now))
+                self._conn.execute("DELETE FROM tiles WHERE fetched < ?", (now - self.ttl,))
+                self._conn.commit()
+            except sqlite3.Error as e:
+                log.error("Error in storing tile {0}: {1}".format(key, e))
+
+    def stats(self):
+        with self._lock:
+            total = self.hits + self.misses
+            return {"hits": self.hits, "misses": self.misses, "hit_rate": float(self.hits) / total if total else 0.0}
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+class SharedFetcher(object):
+    """ Fetcher front that answers from a TileCache when another process has
+        fetched the same coordinates recently. Only usable responses are
+        shared, an overloaded one is left for each caller to retry"""
+
+    def __init__(self, fetcher, cache, lease=_DEFAULT_FETCH_LEASE):
+        self.fetcher    = fetcher
+        self.cache      = cache
+        self.lease      = float(lease)
+        self.owner      = str(os.getpid())
+
+    def fetch(self, coordinates):
+        key = "{0},{1}".format(coordinates[0], coordinates[1])
+        body = self.cache.get(key)
+        if body is not None:
+            return body
+
+        if not self.cache.lease(key, self.owner, self.lease):
+            # another shard is fetching this tile right now, use its result
+            body = self.cache.wait(key, self.lease)
+            if body is not None:
+                return body
+            self.cache.lease(key, self.owner, self.lease)
+
+        try:
+            body = self.fetcher.fetch(coordinates)
+            if body:
+                try:
+                    if find_results(body) is not None:
+                        self.cache.put(key, body)
+                except ValueError:
+                    pass
+        finally:
+            self.cache.release(key, self.owner)
+        return body
+
+    def close(self):
+        self.fetcher.close()
+        self.cache.close()
@@ -0,0 +1,79 @@
+import time
+import logging
+import threading
+
+from lib.constants import _DEFAULT_WRITE_BATCH, _DEFAULT_WRITE_INTERVAL
+
+log = logging.getLogger(__name__)
+
+class WriteBehind(object):
+    """ Buffer database mutations and hand them to `apply` in batches, either
+        when `max_batch` are pending or `interval` seconds after the first one.
+        `apply` gets the list of pending operations and writes them in one
+        transaction"""
+
+    def __init__(self, apply, max_batch=_DEFAULT_WRITE_BATCH, interval=_DEFAULT_WRITE_INTERVAL):
+        self.apply      = apply
+        self.max_batch  = int(max_batch)
+        self.interval   = float(interval)
+
+        self._pending   = []
+        self._first     = None      # time the oldest pending operation was queued
+        self._cond      = threading.Condition()
+        self._flush_lock = threading.Lock()
+        self._running   = True
+
+        self._thread = threading.Thread(target=self._run, name="write-behind")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def __len__(self):
+        with self._cond:
+            return len(self._pending)
+
+    def put(self, operation):
+        with self._cond:
+            if not self._pending:
+                self._first = time.time()
+            self._pending.append(operation)
+            if len(self._pending) >= self.max_batch:
+                self._cond.notify()
+
+    def flush(self):
+        """ Write everything queued so far before returning"""
+        with self._flush_lock:
+            with self._cond:
+                batch = self._pending
+                self._pending = []
+                self._first = None
+            if batch:
+                self.apply(batch)
+            return len(batch)
+
+    def close(self):
+        with self._cond:
+            self._running = False
+            self._cond.notify()
+        self._thread.join()
+        flushed = self.flush()
+        log.info("Flushed {0} pending writes on shutdown".format(flushed))
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while self._running and not self._due():
+                    if self._pending:
+                        self._cond.wait(max(0.0, self._first + self.interval - time.time()))
+                    else:
+                        self._cond.wait()
+                if not self._running:
+                    return
+            try:
+                self.flush()
+            except Exception:
+                log.exception("Error in flushing pending writes")
+
+    def _due(self):
+        if not self._pending:
+            return False
+        return len(self._pending) >= self.max_batch or time.time() - self._first >= self.interval
@@ -0,0 +1,135 @@
+""" Fetcher against a stub upstream on localhost.
+
+    python -m unittest discover -s tests -t .
+"""
+import zlib
+import gzip
+import threading
+import unittest
+import urlparse
+from StringIO import StringIO
+from SocketServer import ThreadingMixIn
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+
+from lib.fetcher import Fetcher, _HEADERS
+
+_BODY = '{"result": [{"pokemon_id": "PIDGEY", "latitude": 1.3, "longitude": 103.8}]}'
+
+def _gzip(body):
+    buf = StringIO()
+    f = gzip.GzipFile(fileobj=buf, mode="wb")
+    f.write(body)
+    f.close()
+    return buf.getvalue()
+
+def _deflate(body):
+    return zlib.compress(body)
+
+def _raw_deflate(body):
+    compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -zlib.MAX_WBITS)
+    return compressor.compress(body) + compressor.flush()
+
+_ENCODINGS = {"gzip": _gzip, "deflate": _deflate, "raw-deflate": _raw_deflate}
+
+class _Server(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+class StubUpstream(object):
+    """ Keep-alive HTTP/1.1 server that answers every GET with _BODY, encoded
+        as the `enc` query parameter asks, and records what it was sent.
+
+        With drop_after set, it closes the connection after that response
+        without telling the client, as an upstream timing out idle
+        connections does"""
+
+    def __init__(self):
+        self.requests   = []    # (path, headers, client port)
+        self.drop_after = False
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_GET(self):
+                stub.requests.append((self.path, dict(self.headers.items()), self.client_address[1]))
+                query = urlparse.parse_qs(urlparse.urlparse(self.path).query)
+                encoding = query.get("enc", [""])[0]
+                body = _ENCODINGS[encoding](_BODY) if encoding else _BODY
+
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                if encoding:
+                    self.send_header("Content-Encoding", "deflate" if encoding == "raw-deflate" else encoding)
+                self.end_headers()
+                self.wfile.write(body)
+                if stub.drop_after:
+                    self.close_connection = 1
+
+            def log_message(self, format, *args):
+                pass
+
+        self._server = _Server(("127.0.0.1", 0), Handler)
+        self.port = self._server.server_address[1]
+        self._thread = threading.Thread(target=self._server.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def close(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+class FetcherTest(unittest.TestCase):
+    def setUp(self):
+        self.stub = StubUpstream()
+        self.fetcher = Fetcher("http://127.0.0.1:{0}/".format(self.stub.port), timeout=5.0, pool_size=2)
+
+    def tearDown(self):
+        self.fetcher.close()
+        self.stub.close()
+
+    def test_plain(self):
+        self.assertEqual(self.fetcher.get("enc="), _BODY)
+
+    def test_gzip(self):
+        self.assertEqual(self.fetcher.get("enc=gzip"), _BODY)
+
+    def test_deflate(self):
+        self.assertEqual(self.fetcher.get("enc=deflate"), _BODY)
+
+    def test_raw_deflate(self):
+        self.assertEqual(self.fetcher.get("enc=raw-deflate"), _BODY)
+
+    def test_headers(self):
+        self.fetcher.fetch((1.3, 103.8))
+        path, headers, port = self.stub.requests[0]
+        self.assertEqual(path, "/?key=allow-all&ts=0&lat=1.3&lng=103.8")
+        for name, value in _HEADERS.items():
+            self.assertEqual(headers.get(name), value)
+
+    def test_connection_reuse(self):
+        for i in range(3):
+            self.assertEqual(self.fetcher.get("enc=gzip"), _BODY)
+        ports = set(port for path, headers, port in self.stub.requests)
+        self.assertEqual(len(self.stub.requests), 3)
+        self.assertEqual(len(ports), 1)
+
+    def test_retry_on_stale_connection(self):
+        self.stub.drop_after = True
+        self.assertEqual(self.fetcher.get("enc="), _BODY)
+        # the pooled connection is now dead, the fetch retries once on a new one
+        self.assertEqual(self.fetcher.get("enc="), _BODY)
+        self.assertEqual(len(self.stub.requests), 2)
+        self.assertNotEqual(self.stub.requests[0][2], self.stub.requests[1][2])
+
+    def test_single_retry(self):
+        self.stub.drop_after = True
+        self.assertEqual(self.fetcher.get("enc="), _BODY)
+        self.stub.close()
+        # the pooled connection fails, and so does the one fresh retry
+        self.assertEqual(self.fetcher.get("enc="), None)
+        self.assertEqual(len(self.stub.requests), 1)
+
+if __name__ == "__main__":
+    unittest.main()
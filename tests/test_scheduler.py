@@ -0,0 +1,74 @@
+""" TileScheduler's scan timing over a simulated hour.
+
+    python -m unittest discover -s tests -t .
+"""
+import unittest
+
+from lib.scheduler import TileScheduler
+from lib.sighting import Sighting
+
+_START = 1500000000.0
+_HOUR = 3600
+
+def _busy(now, start=_START, every=30, lifetime=900):
+    """ Sightings on a tile where a new pokemon turns up every `every` seconds
+        and stays for `lifetime`, as at a busy spawn cluster"""
+    sightings = []
+    t = start - lifetime
+    while t <= now:
+        if t + lifetime > now:
+            sightings.append(Sighting("PIDGEY", "pidgey", 1.3 + t / 1e9, 103.8, int(t + lifetime), ""))
+        t += every
+    return sightings
+
+class TileSchedulerTest(unittest.TestCase):
+    def setUp(self):
+        self.scheduler = TileScheduler(tile_size=0.01)
+        self.tile = self.scheduler.subscribe(1, 1.3, 103.8)
+        self.scheduler.spread(_START)
+
+    def scan(self, until, hasten_at=None):
+        """ Times at which the tile is scanned, observing a busy tile each time,
+            and when it was hastened"""
+        scans = []
+        hastened = None
+        now = self.scheduler.next_scan(self.tile)
+        while now < until:
+            self.assertEqual(self.scheduler.due(now), [self.tile])
+            if hasten_at is not None and now >= hasten_at:
+                self.scheduler.hasten(self.tile, now)
+                hastened, hasten_at = now, None
+            self.scheduler.observe(self.tile, _busy(now), now)
+            scans.append(now)
+            now = self.scheduler.next_scan(self.tile)
+        return scans, hastened
+
+    def test_events_respect_min_interval(self):
+        scans, hastened = self.scan(_START + _HOUR)
+        gaps = [b - a for a, b in zip(scans, scans[1:])]
+        self.assertTrue(gaps)
+        self.assertGreaterEqual(min(gaps), self.scheduler.min_interval)
+        self.assertLessEqual(len(scans), _HOUR / self.scheduler.min_interval + 1)
+
+    def test_hastened_respects_fav_interval(self):
+        scans, hastened = self.scan(_START + _HOUR, hasten_at=_START + 600)
+        until = hastened + self.scheduler.fav_window
+        window = [(a, b) for a, b in zip(scans, scans[1:]) if a >= hastened and b <= until]
+        self.assertTrue(window)
+        for a, b in window:
+            self.assertGreaterEqual(b - a, self.scheduler.fav_interval)
+        # and back to min_interval once the window is over
+        for a, b in zip(scans, scans[1:]):
+            if a >= until:
+                self.assertGreaterEqual(b - a, self.scheduler.min_interval)
+
+    def test_events_bring_scans_forward(self):
+        now = self.scheduler.next_scan(self.tile)
+        self.scheduler.due(now)
+        soon = Sighting("PIDGEY", "pidgey", 1.3, 103.8, int(now + 200), "")
+        self.scheduler.observe(self.tile, [soon], now)
+        self.assertLessEqual(self.scheduler.next_scan(self.tile), now + 200 + self.scheduler.settle)
+        self.assertGreaterEqual(self.scheduler.next_scan(self.tile), now + self.scheduler.min_interval)
+
+if __name__ == "__main__":
+    unittest.main()